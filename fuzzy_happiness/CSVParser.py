@@ -1,77 +1,216 @@
+import binascii
+import re
 
-class CSVParser:
+
+# A single field of a row, followed by its delimiter (or the end of the row).
+# Quoted strings use the "unrolled loop" form so that the regexp engine can
+# consume runs of ordinary characters without backtracking, and understand
+# both MySQL backslash escapes and doubled quotes.
+_FIELD_PATTERN = r"""
+    \s*
+    (
+        (?:_[A-Za-z0-9]+\s*)?               # optional charset introducer,
+                                            # e.g. _binary
+        '[^'\\]*(?:(?:\\.|'')[^'\\]*)*'     # single quoted string
+      |
+        "[^"\\]*(?:(?:\\.|"")[^"\\]*)*"     # double quoted string
+      |
+        [^'"\s%(delimiter)s%(stop)s]+       # NULL, numbers, 0x literals
+    )
+    \s*
+    %(terminator)s
+"""
+
+# MySQL string literal escapes, as written by mysqldump
+_UNESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t',
+              'Z': '\x1a', '%': '\\%', '_': '\\_'}
+_ESCAPES = {'\0': '\\0', '\n': '\\n', '\r': '\\r', '\x1a': '\\Z',
+            '\\': '\\\\', "'": "\\'", '"': '\\"'}
+_re_unescape = {"'": re.compile(r"\\(.)|''", re.DOTALL),
+                '"': re.compile(r'\\(.)|""', re.DOTALL)}
+_re_escape = re.compile('[\0\n\r\x1a\\\\\'"]')
+
+# What LOAD DATA INFILE understands with its default FIELDS ESCAPED BY '\\'
+_TSV_ESCAPES = {'\0': '\\0', '\n': '\\n', '\r': '\\r', '\t': '\\t',
+                '\\': '\\\\'}
+_re_tsv_escape = re.compile('[\0\n\r\t\\\\]')
+_re_introducer = re.compile(r"_[A-Za-z0-9]+\s*")
+
+# The punctuation between the rows of an INSERT statement's VALUES
+_ROW_START_RE = re.compile(r'\s*\(')
+_ROW_END_RE = re.compile(r'\s*(?:(,)|;|\Z)')
+_ROW_DELIMITER_RE = re.compile(r'\s*([,;])')
+
+
+def _unescape_match(m):
+    c = m.group(1)
+    if c is None:
+        # A doubled quote
+        return m.group(0)[0]
+    return _UNESCAPES.get(c, c)
+
+
+def unquote(field):
+    """Return the value of a single or double quoted SQL string literal,
+    undoing any escaping."""
+    return _re_unescape[field[0]].sub(_unescape_match, field[1:-1])
+
+
+def quote(value):
+    """Return value as a single quoted SQL string literal, escaped the way
+    mysqldump does it."""
+    return "'%s'" % _re_escape.sub(lambda m: _ESCAPES[m.group(0)], value)
+
+
+def tsv_field(literal, numeric=False):
+    """Return the value of a SQL literal, as a field of a tab separated file
+    for LOAD DATA INFILE with its default escaping. NULL becomes \\N. A 0x
+    literal is a string of bytes, or a number if numeric is true, the way
+    MySQL takes it for a numeric column."""
+    if literal == 'NULL':
+        return '\\N'
+    if literal.startswith('_'):
+        # A charset introducer, e.g. _binary
+        literal = literal[_re_introducer.match(literal).end():]
+    if literal[:1] in ("'", '"'):
+        value = unquote(literal)
+    elif literal[:2] in ('0x', '0X'):
+        digits = literal[2:]
+        if numeric:
+            value = str(int(digits, 16))
+        else:
+            value = binascii.unhexlify('0' * (len(digits) % 2) + digits)
+    else:
+        value = literal
+    return _re_tsv_escape.sub(lambda m: _TSV_ESCAPES[m.group(0)], value)
+
+
+class CSVParser(object):
     """Parser for CSV files.
 
     Includes things such as:
       * Quotes strings containing all kinds of things
       * delimiters that are quoted
+      * MySQL backslash escapes and doubled quotes inside quoted strings
+      * NULL, _binary and 0x literals
 
+    A row is split in a single pass by a compiled regular expression, and
+    the parser holds no per-row state, so one parser can be reused for
+    every row of a dump.
     """
 
-    (Normal, InSingleQuote, InDoubleQuote) = range(3)
-
     def __init__(self, delimiter=','):
         """Create a new parser"""
         self._delimiter = delimiter
-
-        self._fields = []
-        self._current_field = ""
-        self._state = self.Normal
-
-        self.addField = self._fields.append
-
-        self._lookup = [
-            self._process_normal,
-            self._process_in_single_quote,
-            self._process_in_double_quote,
-        ]
-
-    def _process_normal(self, c):
-        if c == self._delimiter:
-            if self._current_field != "":
-                # we've already been building up a field
-                # so finish this one, and start afresh
-                self.addField(self._current_field)
-                self._current_field = ""
-                return
-
-        # Skip whitespace
-        if c == " ":
-            return
-
-        # Handle quoting
-        if c == "'":
-            self._state = self.InSingleQuote
-            # Fall through as we still want this character added
-        if c == '"':
-            self._state = self.InDoubleQuote
-            # Fall through as we still want this character added
-
-        # We're building a field
-        self._current_field += c
-        return
-
-    def _process_in_double_quote(self, c):
-        if c == '"':
-            # Leaving the double quoted mode
-            self._state = self.Normal
-        self._current_field += c
-
-    def _process_in_single_quote(self, c):
-        if c == "'":
-            # Leaving the single quoted mode
-            self._state = self.Normal
-        self._current_field += c
+        delimiter = re.escape(delimiter)
+        self._field_re = re.compile(
+            _FIELD_PATTERN % {'delimiter': delimiter,
+                              'stop': '',
+                              'terminator': r'(?:%s|\Z)' % delimiter},
+            re.VERBOSE | re.DOTALL)
+        # Within a row of VALUES the last field is ended by a bracket, and
+        # group 2 tells us whether another field follows it
+        self._row_field_re = re.compile(
+            _FIELD_PATTERN % {'delimiter': delimiter,
+                              'stop': r'\)',
+                              'terminator': r'(?:(%s)|\))' % delimiter},
+            re.VERBOSE | re.DOTALL)
 
     def parse(self, str):
         """Parse str and return a list of string fields"""
-        i = 0
+        fields = []
+        match = self._field_re.match
+        pos = 0
         strlen = len(str)
-        while i < strlen:
-            c = str[i]
-            self._lookup[self._state](c)
-            i += 1
-        # The last field case
-        if self._current_field != "":
-            self.addField(self._current_field)
-        return self._fields
+        while pos < strlen:
+            m = match(str, pos)
+            if not m:
+                if str[pos:].isspace():
+                    # Trailing whitespace after the last field
+                    break
+                raise ValueError('Unable to parse field at offset %d of %r'
+                                 % (pos, str))
+            fields.append(m.group(1))
+            pos = m.end()
+        return fields
+
+    def row_spans(self, str, pos=0):
+        """Scan the rows of an INSERT statement's VALUES in str, starting at
+        pos.
+
+        For each row, yield a list of (start, end) offsets of its fields
+        within str. The caller can then slice out just the fields it cares
+        about, and copy everything else verbatim. Scanning stops at the
+        semicolon ending the statement, or at the end of str.
+        """
+        row_start = _ROW_START_RE.match
+        row_field = self._row_field_re.match
+        row_end = _ROW_END_RE.match
+        strlen = len(str)
+        while True:
+            m = row_start(str, pos)
+            if not m:
+                raise ValueError('Expected a row at offset %d' % pos)
+            pos = m.end()
+
+            spans = []
+            more = True
+            while more:
+                m = row_field(str, pos)
+                if not m:
+                    raise ValueError('Unable to parse field at offset %d'
+                                     % pos)
+                spans.append(m.span(1))
+                more = m.group(2) is not None
+                pos = m.end()
+            yield spans
+
+            m = row_end(str, pos)
+            if not m:
+                raise ValueError('Expected a delimiter at offset %d' % pos)
+            if m.group(1) is None or m.end() >= strlen:
+                return
+            pos = m.end()
+
+    def complete_rows(self, str, pos=0):
+        """Scan the rows of an INSERT statement's VALUES in str, starting at
+        pos, where str may stop part way through a row.
+
+        Returns the field spans of the rows which are complete, as
+        row_spans() yields them, the offset just past the last of them and
+        its delimiter, and whether that delimiter was the semicolon ending
+        the statement, in which case the offset is just before it. A row
+        only counts as complete once its delimiter has been seen.
+        """
+        row_start = _ROW_START_RE.match
+        row_field = self._row_field_re.match
+        delimiter = _ROW_DELIMITER_RE.match
+        rows = []
+        end = pos
+        while True:
+            m = row_start(str, pos)
+            if not m:
+                break
+            pos = m.end()
+
+            spans = []
+            more = True
+            while more:
+                m = row_field(str, pos)
+                if not m:
+                    return rows, end, False
+                spans.append(m.span(1))
+                more = m.group(2) is not None
+                pos = m.end()
+
+            m = delimiter(str, pos)
+            if not m:
+                break
+            rows.append(spans)
+            if m.group(1) == ';':
+                return rows, pos, True
+            pos = end = m.end()
+
+        if str[pos:].strip():
+            raise ValueError('Expected a row or delimiter at offset %d' % pos)
+        return rows, end, False
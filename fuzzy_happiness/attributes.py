@@ -15,17 +15,82 @@
 # under the License.
 
 
+import imp
 import inspect
+import json
+import os
+import subprocess
 import sys
+import tempfile
 
-from nova.db.sqlalchemy import models
 from oslo.config import cfg
 
+import policy
+
 
 CONF = cfg.CONF
 
+# The same as nova's own debug option, so that it doesn't matter which of us
+# registers it first
+debug_opt = cfg.BoolOpt('debug',
+                        short='d',
+                        default=False,
+                        help='Print debugging output (set logging level to '
+                             'DEBUG instead of default WARNING level).')
+
+cli_opts = [
+    cfg.StrOpt('config_cache',
+               default='~/.cache/fuzzy-happiness/attributes.json',
+               help=('Where to keep the anonymisation configuration read '
+                     'from the nova models, so that nova only needs '
+                     'importing when the models change.')),
+    cfg.StrOpt('policy',
+               default=None,
+               help=('A JSON or YAML file saying which columns of which '
+                     'tables to anonymise, used instead of the nova '
+                     'models.')),
+]
+
+try:
+    CONF.register_cli_opt(debug_opt)
+except cfg.DuplicateOptError:
+    # Registered by a nova we imported, which is fine
+    pass
+CONF.register_cli_opts(cli_opts)
+
+_MODELS = ('nova', 'db', 'sqlalchemy', 'models')
+
+
+def _models():
+    # nova is slow to import and registers options of its own, so is only
+    # imported when we really need it
+    from nova.db.sqlalchemy import models
+    return models
+
+
+def find_models():
+    """Return the path of nova's models.py without importing nova, or None
+    if nova isn't installed."""
+    path = None
+    try:
+        for name in _MODELS:
+            f, filename, _ = imp.find_module(name, path and [path])
+            if f:
+                f.close()
+            path = filename
+    except ImportError:
+        return None
+    return path
+
+
+def _stamp(path):
+    """What identifies a version of the models file"""
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_mtime, st.st_size]
+
 
 def load_configuration():
+    models = _models()
     configs = {}
 
     for name, obj in inspect.getmembers(models):
@@ -42,8 +107,8 @@ def load_configuration():
 
         if attrs_missing:
             if CONF.debug:
-                print ('Required attributes %s missing from %s'
-                       % (', '.join(attrs_missing), name))
+                print >>sys.stderr, ('Required attributes %s missing from %s'
+                                     % (', '.join(attrs_missing), name))
             continue
 
         configs[obj.__tablename__] = obj.__confidential__
@@ -51,7 +116,82 @@ def load_configuration():
     return configs
 
 
+def export_configuration(path):
+    """Write the configuration to a cache at path, keyed by the models file
+    it came from"""
+    cache = {'config': load_configuration(),
+             'models': _stamp(find_models())}
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.attributes')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.rename(temp, path)
+
+
+def _read_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def load_cached_configuration():
+    """Return the configuration from the cache, exporting it again first if
+    the nova models have changed since it was written.
+
+    The export is done by fhattributes in a process of its own, as nova
+    can't be imported once our options have been parsed.
+    """
+    path = os.path.expanduser(CONF.config_cache)
+    models = find_models()
+    cache = _read_cache(path)
+    if cache is not None:
+        if models is None:
+            print >>sys.stderr, ('nova is not installed, so using %s as it '
+                                 'is' % path)
+            return cache['config']
+        if cache['models'] == _stamp(models):
+            return cache['config']
+    elif models is None:
+        raise ImportError('nova is not installed, and there is no cached '
+                          'configuration in %s' % path)
+
+    print >>sys.stderr, 'Exporting configuration from %s' % models
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+    command = [sys.executable, '-c',
+               'import sys; from fuzzy_happiness import attributes; '
+               'sys.exit(attributes.main())',
+               '--export', '--config_cache', path]
+    if CONF.debug:
+        command.append('--debug')
+    # Keep stdout free for tools writing a dump to it
+    try:
+        subprocess.check_call(command, env=env, stdout=sys.stderr)
+    except subprocess.CalledProcessError as e:
+        # Reported like any other configuration which can't be read
+        raise IOError('Exporting the configuration from %s failed with '
+                      'exit status %d' % (models, e.returncode))
+    cache = _read_cache(path)
+    if cache is None:
+        raise IOError('Exporting the configuration from %s did not write '
+                      '%s' % (models, path))
+    return cache['config']
+
+
+def get_configuration():
+    """Return the configuration the tools should use, from the policy file
+    if one was given, else from the nova models"""
+    if CONF.policy:
+        return policy.load_policy(CONF.policy)
+    return load_cached_configuration()
+
+
 def map_tables_to_model_names(tables):
+    models = _models()
     results = {}
     for name, obj in inspect.getmembers(models):
         if hasattr(obj, '__tablename__'):
@@ -60,6 +200,21 @@ def map_tables_to_model_names(tables):
     return results
 
 
+export_opt = cfg.BoolOpt('export',
+                         default=False,
+                         help=('Write the configuration to the cache used by '
+                               'the other tools, rather than printing it.'))
+
+
 def main():
+    # nova registers command line options, which has to happen before they
+    # are parsed
+    _models()
+    CONF.register_cli_opt(export_opt)
     CONF(sys.argv[1:], project='fuzzy-happiness')
+    if CONF.export:
+        path = os.path.expanduser(CONF.config_cache)
+        export_configuration(path)
+        print >>sys.stderr, 'Wrote %s' % path
+        return 0
     print load_configuration()
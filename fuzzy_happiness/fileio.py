@@ -0,0 +1,561 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import bz2
+import mmap
+import os
+import Queue
+import shutil
+import subprocess
+import sys
+import threading
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+# The filename meaning stdin or stdout, depending on the direction
+STDIO = '-'
+
+# How much compressed data to read, or uncompressed data to collect before
+# compressing it, at a time
+_CHUNK_SIZE = 1024 * 1024
+
+# How many chunks may be queued between a compression thread and the
+# thread doing the anonymisation
+_QUEUE_DEPTH = 16
+
+
+class _Codec(object):
+    """A compression format. Formats which Python can't handle itself are
+    handed to an external command instead."""
+
+    def __init__(self, name, magic, extension, command,
+                 decompressor=None, compressor=None):
+        self.name = name
+        self.magic = magic
+        self.extension = extension
+        self.command = command
+        self.decompressor = decompressor
+        self.compressor = compressor
+
+
+def _gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def _gzip_compressor():
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+_CODECS = [
+    _Codec('gzip', '\x1f\x8b', '.gz', 'gzip',
+           _gzip_decompressor, _gzip_compressor),
+    _Codec('bz2', 'BZh', '.bz2', 'bzip2',
+           bz2.BZ2Decompressor, bz2.BZ2Compressor),
+    _Codec('xz', '\xfd7zXZ\x00', '.xz', 'xz',
+           lzma and lzma.LZMADecompressor, lzma and lzma.LZMACompressor),
+    _Codec('zstd', '\x28\xb5\x2f\xfd', '.zst', 'zstd'),
+]
+_MAGIC_LENGTH = max(len(codec.magic) for codec in _CODECS)
+
+
+def _codec_for_magic(magic):
+    for codec in _CODECS:
+        if magic.startswith(codec.magic):
+            return codec
+    return None
+
+
+def _codec_for_path(path):
+    for codec in _CODECS:
+        if path.endswith(codec.extension):
+            return codec
+    return None
+
+
+def _decompress(raw, data, codec):
+    """Yield the decompressed contents of raw, which starts with data.
+    Concatenated streams, as written by pigz or pbzip2, are handled."""
+    decompressor = codec.decompressor()
+    while True:
+        if not data:
+            data = raw.read(_CHUNK_SIZE)
+            if not data:
+                return
+        try:
+            out = decompressor.decompress(data)
+        except EOFError:
+            # The last stream ended exactly at the end of a chunk
+            decompressor = codec.decompressor()
+            continue
+        data = ''
+        if out:
+            yield out
+        if getattr(decompressor, 'unused_data', ''):
+            data = decompressor.unused_data
+            decompressor = codec.decompressor()
+
+
+def _read_chunks(raw, data):
+    """Yield the contents of raw, which starts with data"""
+    while True:
+        if data:
+            yield data
+        data = raw.read(_CHUNK_SIZE)
+        if not data:
+            return
+
+
+def _feed(raw, data, pipe):
+    """Copy data followed by the rest of raw into pipe"""
+    try:
+        for chunk in _read_chunks(raw, data):
+            pipe.write(chunk)
+    except IOError:
+        # The command went away, and will report why itself
+        pass
+    finally:
+        pipe.close()
+
+
+class ThreadedReader(object):
+    """A read only file whose contents are produced by a background thread,
+    so that decompression overlaps with whatever the reader is doing."""
+
+    def __init__(self, chunks, cleanup=None, abort=None):
+        self._queue = Queue.Queue(maxsize=_QUEUE_DEPTH)
+        self._cleanup = cleanup
+        self._abort = abort
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, args=(chunks,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, chunks):
+        try:
+            for chunk in chunks:
+                if self._closed:
+                    break
+                self._queue.put(chunk)
+        except Exception:
+            self._queue.put(sys.exc_info())
+        self._queue.put(None)
+
+    def _fill(self):
+        """Add the next chunk to the buffer, returning False at EOF"""
+        if self._eof:
+            return False
+        chunk = self._queue.get()
+        if chunk is None:
+            self._eof = True
+            return False
+        if isinstance(chunk, tuple):
+            self._eof = True
+            exc_type, exc_value, exc_tb = chunk
+            raise exc_type, exc_value, exc_tb
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def readline(self, size=-1):
+        while True:
+            end = self._buffer.find('\n', self._pos)
+            if end != -1:
+                end += 1
+                break
+            if 0 <= size <= len(self._buffer) - self._pos:
+                end = len(self._buffer)
+                break
+            if not self._fill():
+                end = len(self._buffer)
+                break
+        if size >= 0:
+            end = min(end, self._pos + size)
+        line = self._buffer[self._pos:end]
+        self._pos = end
+        return line
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) - self._pos < size:
+            if not self._fill():
+                break
+        if size < 0:
+            end = len(self._buffer)
+        else:
+            end = min(self._pos + size, len(self._buffer))
+        data = self._buffer[self._pos:end]
+        self._pos = end
+        return data
+
+    def unread(self, data):
+        """Put data back, to be read again next"""
+        self._buffer = data + self._buffer[self._pos:]
+        self._pos = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._abort and not self._eof:
+            self._abort()
+        # Unblock the thread if it is waiting on a full queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        if self._cleanup:
+            self._cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+class MappedReader(object):
+    """A read only regular file, mapped into memory rather than read, so
+    that lines are found by searching the mapping in place instead of being
+    copied through a read buffer first."""
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._map = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def readline(self, size=-1):
+        if size < 0:
+            return self._map.readline()
+        pos = self._map.tell()
+        end = self._map.find('\n', pos, pos + size)
+        if end == -1:
+            end = pos + size
+        else:
+            end += 1
+        return self._map.read(end - pos)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self._map) - self._map.tell()
+        return self._map.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._map.seek(offset, whence)
+
+    def tell(self):
+        return self._map.tell()
+
+    def unread(self, data):
+        """Put data back, to be read again next"""
+        self._map.seek(-len(data), os.SEEK_CUR)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self._map.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self._map.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+def _map(raw):
+    """Return a MappedReader for raw if it can be mapped, else raw"""
+    try:
+        if os.fstat(raw.fileno()).st_size:
+            return MappedReader(raw)
+    except EnvironmentError:
+        pass
+    raw.seek(0)
+    return raw
+
+
+class ThreadedWriter(object):
+    """A write only file whose contents are compressed and written out by a
+    background thread, so that compression overlaps with whatever the
+    writer is doing."""
+
+    def __init__(self, raw, compressor=None, cleanup=None):
+        self._raw = raw
+        self._compressor = compressor
+        self._cleanup = cleanup
+        self._pending = []
+        self._pending_size = 0
+        self._queue = Queue.Queue(maxsize=_QUEUE_DEPTH)
+        self._failure = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if self._failure:
+                # Keep draining so that the writer never blocks
+                if data is None:
+                    return
+                continue
+            try:
+                if data is None:
+                    if self._compressor:
+                        self._raw.write(self._compressor.flush())
+                    return
+                if self._compressor:
+                    data = self._compressor.compress(data)
+                self._raw.write(data)
+            except Exception:
+                self._failure = sys.exc_info()
+
+    def _check(self):
+        if self._failure:
+            exc_type, exc_value, exc_tb = self._failure
+            raise exc_type, exc_value, exc_tb
+
+    def write(self, data):
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= _CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        self._check()
+        if self._pending:
+            self._queue.put(''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._raw.close()
+            if self._cleanup:
+                self._cleanup()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+def _unread(f, data):
+    if hasattr(f, 'unread'):
+        f.unread(data)
+    else:
+        f.seek(-len(data), os.SEEK_CUR)
+
+
+def read_while(f, prefix):
+    """Yield the contents of f in large chunks for as long as its lines
+    start with prefix, leaving f positioned at the start of the first line
+    which doesn't.
+
+    f must be at the start of a line, and be a regular file or something
+    opened by open_input(). This lets the caller copy lines it has no
+    interest in without reading them a line at a time.
+    """
+    pending = ''
+    while True:
+        # Look at how the next line starts
+        while len(pending) < len(prefix):
+            chunk = f.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            pending += chunk
+        if not pending.startswith(prefix):
+            if pending:
+                _unread(f, pending)
+            return
+
+        # All of that line can go, however long it is
+        end = pending.find('\n')
+        while end == -1:
+            yield pending
+            pending = f.read(_CHUNK_SIZE)
+            if not pending:
+                return
+            end = pending.find('\n')
+
+        # Along with any more whole lines we have which start with prefix
+        start = end + 1
+        while (len(pending) - start >= len(prefix) and
+               pending.startswith(prefix, start)):
+            end = pending.find('\n', start)
+            if end == -1:
+                break
+            start = end + 1
+        yield pending[:start]
+        pending = pending[start:]
+
+
+def copy_range(f, out, start, end):
+    """Copy bytes start to end of f, which must be seekable, to out"""
+    f.seek(start)
+    while start < end:
+        data = f.read(min(_CHUNK_SIZE, end - start))
+        if not data:
+            raise IOError('Unexpected end of file at offset %d' % start)
+        out.write(data)
+        start += len(data)
+
+
+def append_file(out, path):
+    """Append the contents of the file at path to out. The copy is done by
+    the kernel where Python offers copy_file_range and both are files."""
+    with open(path, 'rb') as src:
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        if copy_file_range is not None and hasattr(out, 'fileno'):
+            out.flush()
+            try:
+                while copy_file_range(src.fileno(), out.fileno(),
+                                      _CHUNK_SIZE * 64):
+                    pass
+                return
+            except OSError:
+                # Not between these two, so carry on from wherever it got to
+                pass
+        shutil.copyfileobj(src, out, _CHUNK_SIZE)
+
+
+def _wait_for(process, command):
+    def wait():
+        if process.wait() != 0:
+            raise IOError('%s exited with status %d'
+                          % (command, process.returncode))
+    return wait
+
+
+def _read_process(process, command):
+    """Yield the output of process, then check that it succeeded"""
+    for chunk in _read_chunks(process.stdout, ''):
+        yield chunk
+    _wait_for(process, command)()
+
+
+def check_input(path):
+    """Return an error message if path can't be used as input, else None"""
+    if path == STDIO:
+        return None
+    if not os.path.exists(path):
+        return 'Input file %s does not exist!' % path
+    if not os.path.isfile(path):
+        return 'Input %s is not a file!' % path
+    return None
+
+
+def open_input(path):
+    """Open a dump for reading, with '-' meaning stdin.
+
+    Compressed dumps are recognised by their magic bytes, whatever they
+    are called, and are decompressed by a background thread. Uncompressed
+    dumps are memory mapped.
+    """
+    if path == STDIO:
+        # Duplicate the descriptor so that closing the file when we're done
+        # doesn't close stdin itself
+        raw = os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+    else:
+        raw = open(path, 'rb')
+
+    magic = raw.read(_MAGIC_LENGTH)
+    codec = _codec_for_magic(magic)
+    if codec is None:
+        if path != STDIO:
+            return _map(raw)
+        return ThreadedReader(_read_chunks(raw, magic), raw.close)
+
+    if codec.decompressor:
+        return ThreadedReader(_decompress(raw, magic, codec), raw.close)
+
+    process = subprocess.Popen([codec.command, '-dc'], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+    feeder = threading.Thread(target=_feed, args=(raw, magic, process.stdin))
+    feeder.daemon = True
+    feeder.start()
+
+    def abort():
+        if process.poll() is None:
+            process.kill()
+
+    def cleanup():
+        process.stdout.close()
+        feeder.join()
+        raw.close()
+
+    return ThreadedReader(_read_process(process, codec.command), cleanup,
+                          abort)
+
+
+def open_output(path):
+    """Open a dump for writing, with '-' meaning stdout.
+
+    If the filename ends in the extension of a compression format we know,
+    the output is compressed by a background thread.
+    """
+    if path == STDIO:
+        sys.stdout.flush()
+        return os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+
+    codec = _codec_for_path(path)
+    if codec is None:
+        return open(path, 'w')
+
+    raw = open(path, 'wb')
+    if codec.compressor:
+        return ThreadedWriter(raw, codec.compressor())
+
+    process = subprocess.Popen([codec.command, '-c'], stdin=subprocess.PIPE,
+                               stdout=raw)
+    raw.close()
+    return ThreadedWriter(process.stdin,
+                          cleanup=_wait_for(process, codec.command))
@@ -0,0 +1,180 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+def _describe(constraint):
+    return '%s: %s(%s) -> %s(%s)' % (
+        constraint.name, constraint.table.name,
+        ', '.join(element.parent.name for element in constraint.elements),
+        constraint.referred_table.name,
+        ', '.join(element.column.name for element in constraint.elements))
+
+
+class FKPlan(object):
+    """Which foreign keys get in the way of anonymising a database, and
+    the order to anonymise its tables in.
+
+    Only a constraint which references a confidential column needs
+    changing, and then only if it doesn't already cascade updates. The
+    referencing columns of such a constraint are filled in by the cascade,
+    so they are not anonymised separately, which would break the link
+    again. Tables are grouped into levels, with every table coming after
+    the tables it references, so that cascades land before the rest of
+    a table is anonymised.
+
+    In keyed mode constraints are left alone, and instead every column
+    referencing a confidential column is anonymised too, with the same
+    anonymisation type, which gives it the same new values.
+    """
+
+    def __init__(self, metadata, tables, keyed=False):
+        """tables is a list of (table, columns) pairs to anonymise, where
+        columns maps column names to anonymisation types. The tables to
+        anonymise, with any referencing columns added in keyed mode, are
+        left in self.tables."""
+        if keyed:
+            tables = self._with_references(metadata, tables)
+        self.tables = tables
+
+        confidential = set()
+        for table, columns in tables:
+            for name in columns:
+                confidential.add((table.name, name))
+
+        self.rewrite = []
+        self.cascading = []
+        self.cascaded = set()
+        for table in metadata.sorted_tables:
+            for constraint in table.foreign_key_constraints:
+                if not any((element.column.table.name,
+                            element.column.name) in confidential
+                           for element in constraint.elements):
+                    continue
+                if (constraint.onupdate or '').upper() == 'CASCADE':
+                    self.cascading.append(constraint)
+                else:
+                    self.rewrite.append(constraint)
+                for element in constraint.elements:
+                    self.cascaded.add((table.name, element.parent.name))
+
+        self.levels = self._levels([table for table, _ in tables])
+
+    @staticmethod
+    def _with_references(metadata, tables):
+        """Return tables with the columns referencing confidential columns
+        added, including those referencing them in turn, each with the
+        anonymisation type of the column it references. Primary keys are
+        never anonymised, so columns referencing them are left out. Raises
+        ValueError if a referencing column can't get the same new values."""
+        types = {}
+        for table, columns in tables:
+            for name, column_type in columns.items():
+                types[(table.name, name)] = column_type
+
+        added = True
+        while added:
+            added = False
+            for table in metadata.sorted_tables:
+                for constraint in table.foreign_key_constraints:
+                    for element in constraint.elements:
+                        column_type = types.get((element.column.table.name,
+                                                 element.column.name))
+                        if column_type is None:
+                            continue
+                        referencing = (table.name, element.parent.name)
+                        if element.column.primary_key:
+                            # Primary keys are never anonymised, so the
+                            # columns referencing them mustn't be either
+                            if referencing in types:
+                                raise ValueError(
+                                    '%s.%s is anonymised, but references '
+                                    '%s.%s, which is part of the primary '
+                                    'key so is never anonymised'
+                                    % (referencing +
+                                       (element.column.table.name,
+                                        element.column.name)))
+                            continue
+                        if referencing not in types:
+                            types[referencing] = column_type
+                            added = True
+                        elif types[referencing] != column_type:
+                            raise ValueError(
+                                '%s.%s is anonymised as %s, but references '
+                                '%s.%s, which is anonymised as %s'
+                                % (referencing + (types[referencing],
+                                                  element.column.table.name,
+                                                  element.column.name,
+                                                  column_type)))
+                        if element.parent.primary_key:
+                            raise ValueError(
+                                '%s.%s is part of the primary key, so '
+                                'can\'t follow %s.%s when it is anonymised'
+                                % (referencing + (element.column.table.name,
+                                                  element.column.name)))
+
+        configured = dict((table.name, columns) for table, columns in tables)
+        result = []
+        for name, table in sorted(metadata.tables.items()):
+            columns = dict((column, column_type)
+                           for (table_name, column), column_type
+                           in types.items() if table_name == name)
+            if columns or name in configured:
+                result.append((table, columns))
+        return result
+
+    @staticmethod
+    def _levels(tables):
+        """Group tables so that each comes in a later group than every
+        other one of tables it references. Tables in a cycle go last."""
+        remaining = dict((table.name, table) for table in tables)
+        levels = []
+        while remaining:
+            level = []
+            for name, table in sorted(remaining.items()):
+                parents = set(fkey.column.table.name
+                              for fkey in table.foreign_keys)
+                parents.discard(name)
+                if not parents & set(remaining):
+                    level.append(table)
+            if not level:
+                # A cycle, which no order can satisfy
+                level = [table for _, table in sorted(remaining.items())]
+            for table in level:
+                del remaining[table.name]
+            levels.append(level)
+        return levels
+
+    def columns_for(self, table, columns):
+        """Return columns without those which are filled in by cascades"""
+        return dict((name, column_type)
+                    for name, column_type in columns.items()
+                    if (table.name, name) not in self.cascaded)
+
+    def describe(self):
+        """Return a human readable description of the plan"""
+        lines = ['Update order:']
+        for number, level in enumerate(self.levels):
+            lines.append('  %d: %s' % (number + 1,
+                                       ', '.join(table.name
+                                                 for table in level)))
+        lines.append('Constraints to cascade on update:')
+        for constraint in self.rewrite:
+            lines.append('  ' + _describe(constraint))
+        lines.append('Constraints which already cascade:')
+        for constraint in self.cascading:
+            lines.append('  ' + _describe(constraint))
+        lines.append('Columns filled in by cascades:')
+        for table_name, name in sorted(self.cascaded):
+            lines.append('  %s.%s' % (table_name, name))
+        return '\n'.join(lines)
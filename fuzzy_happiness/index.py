@@ -0,0 +1,167 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import re
+import sys
+import tempfile
+
+from oslo.config import cfg
+
+import CSVParser
+import fileio
+
+
+CONF = cfg.CONF
+
+index_opt = cfg.StrOpt('index',
+                       default=None,
+                       help=('The byte offset index of the dump, as written '
+                             'by fhindex. fhindex writes it next to the '
+                             'dump, with .fhindex added to the name, unless '
+                             'told otherwise.'))
+
+# The lines of a dump which are a CREATE TABLE, its columns and its
+# INSERTs, for fhsqlparse as well as the index
+TABLE_NAME_RE = re.compile('CREATE TABLE `(.+)`')
+COLUMN_RE = re.compile('  `(.+)` ([^ ,]+).*')
+INSERT_RE = re.compile(r'INSERT\s+INTO\s+`([^`]+)`\s+VALUES\s*')
+
+_PARSER = CSVParser.CSVParser()
+
+
+def _stamp(path):
+    """What identifies a version of the dump"""
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+def build_index(f):
+    """Scan the dump in f, which must be uncompressed, and return its index.
+
+    The index has a "tables" list, with the name and columns of each CREATE
+    TABLE in the dump and its byte offset, and an "inserts" list, with the
+    number of the table, the byte offset, the length and the number of rows
+    of each INSERT. An INSERT belongs to the last table of its name created
+    before it. Tables which have INSERTs but no CREATE TABLE get an entry
+    with columns of None.
+    """
+    tables = []
+    numbers = {}
+    inserts = []
+    creating = None
+    offset = 0
+    for line in iter(f.readline, ''):
+        if creating is not None:
+            if line.startswith(')'):
+                creating = None
+            else:
+                m = COLUMN_RE.match(line)
+                if m:
+                    creating['columns'].append([m.group(1), m.group(2)])
+        elif line.startswith('CREATE TABLE'):
+            m = TABLE_NAME_RE.match(line)
+            if m:
+                creating = {'name': m.group(1), 'columns': [],
+                            'offset': offset}
+                numbers[creating['name']] = len(tables)
+                tables.append(creating)
+        elif line.startswith('INSERT'):
+            m = INSERT_RE.match(line)
+            if m:
+                name = m.group(1)
+                if name not in numbers:
+                    numbers[name] = len(tables)
+                    tables.append({'name': name, 'columns': None,
+                                   'offset': None})
+                rows = sum(1 for _ in _PARSER.row_spans(line, m.end()))
+                inserts.append([numbers[name], offset, len(line), rows])
+        offset += len(line)
+    return {'tables': tables, 'inserts': inserts, 'size': offset}
+
+
+def write_index(path, dump_path, index):
+    """Write the index of the dump at dump_path to path"""
+    index = dict(index, dump=_stamp(dump_path))
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.fhindex')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.rename(temp, path)
+    except Exception:
+        os.unlink(temp)
+        raise
+
+
+def load_index(path, dump_path):
+    """Read the index of the dump at dump_path from path, checking that the
+    dump hasn't changed since it was indexed"""
+    with open(path) as f:
+        index = json.load(f)
+    if index.get('dump') != _stamp(dump_path):
+        raise ValueError('%s is out of date, run fhindex on %s again'
+                         % (path, dump_path))
+    return index
+
+
+filename_opt = cfg.StrOpt('filename',
+                          default=None,
+                          help='The dump to index',
+                          positional=True)
+
+
+def main():
+    CONF.register_cli_opt(index_opt)
+    CONF.register_cli_opt(filename_opt)
+    CONF(sys.argv[1:], project='fuzzy-happiness')
+
+    if not CONF.filename:
+        print >>sys.stderr, 'Please specify a filename to index'
+        return 1
+
+    error = fileio.check_input(CONF.filename)
+    if error:
+        print >>sys.stderr, error
+        return 1
+    if CONF.filename == fileio.STDIO:
+        print >>sys.stderr, 'Only a dump in a file can be indexed'
+        return 1
+
+    with fileio.open_input(CONF.filename) as f:
+        if not hasattr(f, 'seek'):
+            print >>sys.stderr, ('%s is compressed, and only uncompressed '
+                                 'dumps can be indexed' % CONF.filename)
+            return 1
+        try:
+            index = build_index(f)
+        except ValueError as e:
+            print >>sys.stderr, 'Error: %s' % e
+            return 1
+
+    path = CONF.index or CONF.filename + '.fhindex'
+    write_index(path, CONF.filename, index)
+
+    rows = {}
+    for number, offset, length, count in index['inserts']:
+        rows[number] = rows.get(number, 0) + count
+    for number, table in enumerate(index['tables']):
+        print >>sys.stderr, ('Table `%s` has %d rows'
+                             % (table['name'], rows.get(number, 0)))
+    print >>sys.stderr, ('Wrote %s, indexing %d inserts'
+                         % (path, len(index['inserts'])))
+    return 0
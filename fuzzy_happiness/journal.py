@@ -0,0 +1,99 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import tempfile
+import threading
+
+
+class Journal(object):
+    """The progress of an anonymisation run, saved to a file after every
+    step so that a run which fails part way through can be resumed.
+
+    For each table it records the primary key ranges the table was split
+    into, and for each range the last primary key committed, how many rows
+    that was, and whether the server side part of the work is done. It
+    also records the foreign keys which have been changed, with what they
+    need restoring to. A journal without a path is only kept in memory.
+    """
+
+    def __init__(self, path, state=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._state = state or {'tables': {}, 'fkeys': {}}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(path, json.load(f))
+
+    def _save(self):
+        if self.path is None:
+            return
+        # Write a new file and rename it over the old one, so that a crash
+        # never leaves a half written journal behind
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.journal')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._state, f, indent=1, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp, self.path)
+        except Exception:
+            os.unlink(temp)
+            raise
+
+    def ranges(self, table, split):
+        """Return the ranges table was split into, calling split() to split
+        it if this is the first time we've seen it. The same ranges are
+        used when resuming, whatever the number of jobs."""
+        with self._lock:
+            tables = self._state['tables']
+            if table not in tables:
+                tables[table] = [{'range': list(bounds), 'last_pk': None,
+                                  'rows': 0, 'pushed': False,
+                                  'done': False}
+                                 for bounds in split()]
+                self._save()
+            return [dict(part) for part in tables[table]]
+
+    def checkpoint(self, table, index, **changes):
+        """Record progress on range index of table"""
+        with self._lock:
+            self._state['tables'][table][index].update(changes)
+            self._save()
+
+    def fkeys_changing(self, restores):
+        """Record foreign keys which are about to be changed, as a dict
+        from their names to the onupdate to restore"""
+        with self._lock:
+            self._state['fkeys'].update(restores)
+            self._save()
+
+    def fkeys_restored(self):
+        with self._lock:
+            self._state['fkeys'] = {}
+            self._save()
+
+    def pending_fkeys(self):
+        """Return the foreign keys which still need restoring"""
+        with self._lock:
+            return dict(self._state['fkeys'])
+
+    def finish(self):
+        """The run is complete, so there's nothing left to resume"""
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,277 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import re
+import time
+
+from oslo.config import cfg
+
+import fileio
+
+
+# The formats the anonymised dump can be written in
+FORMATS = ['sql', 'tsv', 'mydumper']
+
+output_opt = cfg.StrOpt('output',
+                        default=None,
+                        help=('Where to write the anonymised dump, or - for '
+                              'stdout. Defaults to the input filename with '
+                              'a suffix, or stdout when reading stdin.'))
+
+_re_database = re.compile(r'(?:-- Host: .*\sDatabase: |USE `)([^`\s]+)')
+_re_create_table = re.compile(r'CREATE TABLE `([^`]+)`')
+
+
+class Rows(object):
+    """Rows of a table, already converted for the table's data file, and
+    how many rows that is if it is known"""
+
+    def __init__(self, table, data, rows=None):
+        self.table = table
+        self.data = data
+        self.rows = rows
+
+
+class Values(object):
+    """The rows of an INSERT statement, each as its bracketed values, to be
+    put into statements of the right size. prefix is the statement up to
+    the first row."""
+
+    def __init__(self, table, prefix, values):
+        self.table = table
+        self.prefix = prefix
+        self.values = values
+
+
+class Rebatcher(object):
+    """Wraps an output, writing Values as INSERT statements of at most
+    rows_per_insert rows and max_statement_bytes bytes, rather than as the
+    statements they came from. Zero means no limit. Consecutive statements
+    into the same table are merged, and a row too big for any statement
+    gets one of its own. Anything else is written as it is."""
+
+    def __init__(self, out, rows_per_insert=0, max_statement_bytes=0):
+        self.out = out
+        self.rows_per_insert = rows_per_insert
+        self.max_statement_bytes = max_statement_bytes
+        self._table = None
+        self._prefix = None
+        self._pending = []
+        self._size = 0
+
+    def write(self, data):
+        if not isinstance(data, Values):
+            self.flush()
+            self.out.write(data)
+            return
+
+        if data.table != self._table:
+            self.flush()
+            self._table = data.table
+            self._prefix = data.prefix
+        for value in data.values:
+            # Each row adds its separator, or the ; ending the statement
+            size = len(value) + 1
+            if self._pending and (
+                    len(self._pending) == self.rows_per_insert or
+                    (self.max_statement_bytes and
+                     self._size + size > self.max_statement_bytes)):
+                self.flush()
+            if not self._pending:
+                self._size = len(self._prefix)
+            self._pending.append(value)
+            self._size += size
+
+    def flush(self):
+        if self._pending:
+            self.out.write('%s%s;\n'
+                           % (self._prefix, ','.join(self._pending)))
+            self._pending = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+class TSVOutput(object):
+    """A directory holding the dump as files for a fast restore.
+
+    schema.sql is everything in the dump but the data, <table>.tsv holds
+    the rows of each table as tab separated values, and load.sql loads
+    them all with LOAD DATA INFILE. Text is written to schema.sql, Rows
+    to the data file of their table.
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self._schema = fileio.open_output(os.path.join(directory,
+                                                       'schema.sql'))
+        self._tables = []
+        self._table = None
+        self._data = None
+
+    def _data_file(self, table):
+        # Dumps have the data of a table all together, so only the file of
+        # the current table is kept open
+        if table != self._table:
+            if self._data:
+                self._data.close()
+            mode = 'a' if table in self._tables else 'w'
+            if table not in self._tables:
+                self._tables.append(table)
+            self._data = open(os.path.join(self.directory, table + '.tsv'),
+                              mode)
+            self._table = table
+        return self._data
+
+    def write(self, data):
+        if isinstance(data, Rows):
+            self._data_file(data.table).write(data.data)
+        else:
+            self._schema.write(data)
+
+    def close(self):
+        if self._data:
+            self._data.close()
+            self._data = None
+        self._schema.close()
+        with open(os.path.join(self.directory, 'load.sql'), 'w') as f:
+            f.write('SET FOREIGN_KEY_CHECKS=0;\n')
+            for table in self._tables:
+                f.write("LOAD DATA LOCAL INFILE '%s.tsv' INTO TABLE `%s` "
+                        "CHARACTER SET binary;\n" % (table, table))
+            f.write('SET FOREIGN_KEY_CHECKS=1;\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+class MydumperOutput(object):
+    """A directory laid out the way mydumper writes one, so that myloader
+    can restore it with many threads.
+
+    Each table gets a <database>.<table>-schema.sql with its CREATE TABLE,
+    and its rows go in <database>.<table>.<n>.sql chunks of INSERT
+    statements. A chunk is finished at the first statement boundary after
+    it holds chunk_rows rows. Nothing else in the dump is kept. The
+    database is the one named in the dump, or database if it names none.
+    """
+
+    _HEADER = ('/*!40101 SET NAMES binary*/;\n'
+               '/*!40014 SET FOREIGN_KEY_CHECKS=0*/;\n\n')
+
+    def __init__(self, directory, chunk_rows, database='nova'):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.database = database
+        self._named = False
+        self._schema = None
+        self._chunk = None
+        self._table = None
+        self._rows = 0
+        self._chunks = {}
+        with open(os.path.join(directory, 'metadata'), 'w') as f:
+            f.write('Started dump at: %s\n' % self._now())
+
+    def _now(self):
+        return time.strftime('%Y-%m-%d %H:%M:%S')
+
+    def _open(self, name):
+        if not self._named:
+            # The dump names its database, if at all, before any table
+            self._named = True
+            with self._open_file('%s-schema-create.sql' % self.database) as f:
+                f.write('CREATE DATABASE `%s`;\n' % self.database)
+        f = self._open_file('%s.%s' % (self.database, name))
+        f.write(self._HEADER)
+        return f
+
+    def _open_file(self, name):
+        return open(os.path.join(self.directory, name), 'w')
+
+    def write(self, data):
+        if isinstance(data, Rows):
+            self._write_rows(data)
+            return
+
+        if not self._named:
+            m = _re_database.match(data)
+            if m:
+                self.database = m.group(1)
+        if self._schema is None:
+            m = _re_create_table.match(data)
+            if not m:
+                return
+            self._schema = self._open('%s-schema.sql' % m.group(1))
+        self._schema.write(data)
+        if data.startswith(')'):
+            self._schema.close()
+            self._schema = None
+
+    def _write_rows(self, rows):
+        if rows.table != self._table or self._rows >= self.chunk_rows:
+            if self._chunk:
+                self._chunk.close()
+            number = self._chunks.get(rows.table, 0)
+            self._chunks[rows.table] = number + 1
+            self._chunk = self._open('%s.%05d.sql' % (rows.table, number))
+            self._table = rows.table
+            self._rows = 0
+        self._chunk.write(rows.data)
+        self._rows += rows.rows
+
+    def close(self):
+        for f in (self._schema, self._chunk):
+            if f:
+                f.close()
+        self._schema = self._chunk = None
+        with open(os.path.join(self.directory, 'metadata'), 'a') as f:
+            f.write('Finished dump at: %s\n' % self._now())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+def open_output(path, output_format='sql', chunk_rows=None,
+                rows_per_insert=0, max_statement_bytes=0):
+    """Open where the anonymised dump goes, in the given format. For sql
+    that is a file as fileio.open_output() opens it, rebatching INSERTs if
+    there are limits on them, for the others a directory."""
+    if output_format == 'tsv':
+        return TSVOutput(path)
+    if output_format == 'mydumper':
+        return MydumperOutput(path, chunk_rows)
+    out = fileio.open_output(path)
+    if rows_per_insert or max_statement_bytes:
+        return Rebatcher(out, rows_per_insert, max_statement_bytes)
+    return out
@@ -0,0 +1,133 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import multiprocessing
+import Queue
+import sys
+import threading
+
+from oslo.config import cfg
+
+workers_opt = cfg.IntOpt('workers',
+                         default=1,
+                         help=('Number of processes to anonymise INSERT '
+                               'statements with. Output is identical to a '
+                               'single process run.'))
+
+
+class _Done(object):
+    """A result which was computed without going near the pool"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+_STOP = object()
+
+
+def ordered_pipeline(tasks, write, workers, depth=None):
+    """Run tasks on a pool of processes, writing results in input order.
+
+    tasks is an iterable of (func, arg) pairs. Each func(arg) is run on
+    the pool, and write() is called with the results in the order the
+    tasks were produced. A func of None means arg is already the result,
+    which lets cheap work stay in the calling process while still being
+    written in order.
+
+    The caller is the reader stage. A writer thread collects results, and
+    the bounded queue between the two holds at most depth tasks in flight,
+    so a slow writer stops the reader rather than letting results pile up
+    in memory.
+    """
+    if depth is None:
+        depth = workers * 4
+
+    pool = multiprocessing.Pool(workers)
+    in_flight = Queue.Queue(maxsize=depth)
+    failures = []
+
+    def writer():
+        while True:
+            result = in_flight.get()
+            if result is _STOP:
+                return
+            if failures:
+                # Keep draining so the reader never blocks on a full queue
+                continue
+            try:
+                write(result.get())
+            except Exception:
+                failures.append(sys.exc_info())
+
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.daemon = True
+    writer_thread.start()
+
+    try:
+        for func, arg in tasks:
+            if failures:
+                break
+            if func is None:
+                in_flight.put(_Done(arg))
+            else:
+                in_flight.put(pool.apply_async(func, (arg,)))
+    finally:
+        in_flight.put(_STOP)
+        writer_thread.join()
+        pool.close()
+        pool.join()
+
+    if failures:
+        exc_type, exc_value, exc_tb = failures[0]
+        raise exc_type, exc_value, exc_tb
+
+
+def thread_pool(tasks, workers):
+    """Call each of tasks, a list of functions taking no arguments, on a
+    pool of threads, in no particular order.
+
+    Threads suit work which spends most of its time waiting on something
+    else, such as a database. Once a task fails no more are started, and
+    the first failure is raised when the running ones have finished.
+    """
+    pending = Queue.Queue()
+    for task in tasks:
+        pending.put(task)
+    failures = []
+
+    def worker():
+        while not failures:
+            try:
+                task = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                task()
+            except Exception:
+                failures.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(workers, pending.qsize())))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if failures:
+        exc_type, exc_value, exc_tb = failures[0]
+        raise exc_type, exc_value, exc_tb
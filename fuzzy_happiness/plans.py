@@ -0,0 +1,362 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import CSVParser
+import randomise
+import re
+import sys
+
+
+_PARSER = CSVParser.CSVParser()
+
+# The start of a string literal
+_re_quote = re.compile('[\'"]')
+
+# Column types in whose columns MySQL takes a 0x literal as a number
+_re_numeric_type = re.compile(r'(tiny|small|medium|big)?int|integer|decimal|'
+                              r'numeric|float|double|real|bool', re.I)
+
+
+def _literal_transform(transform, column):
+    """Wrap a batch transform of plain values so that it works on the text
+    of SQL literals, taking care of quoting and escaping. Unquoted numbers
+    only have their digits randomised, so that they stay numbers."""
+    numbers = randomise.get_batch_transform('number')
+
+    def anonymise(fields):
+        values = []
+        quotes = []
+        unquoted = []
+        for field in fields:
+            if field == 'NULL':
+                quote_at = -1
+                values.append(None)
+            else:
+                # Strings may be in either kind of quotes, but are always
+                # written back in single ones
+                m = _re_quote.search(field)
+                quote_at = m.start() if m else -1
+                if quote_at != -1:
+                    values.append(CSVParser.unquote(field[quote_at:]))
+                elif randomise.is_number(field):
+                    unquoted.append(len(values))
+                    values.append(None)
+                else:
+                    values.append(field)
+            quotes.append(quote_at)
+
+        randomised = transform(values)
+        for i, number in zip(unquoted,
+                             numbers([fields[i] for i in unquoted])):
+            randomised[i] = number
+
+        literals = []
+        for field, quote_at, value in zip(fields, quotes, randomised):
+            if value is None:
+                if field != 'NULL':
+                    _warn_unanonymised(column)
+                literals.append('NULL')
+            elif quote_at == -1:
+                if randomise.is_number(value):
+                    literals.append(value)
+                else:
+                    literals.append(CSVParser.quote(value))
+            else:
+                # Keep any charset introducer, such as _binary
+                literals.append(field[:quote_at] + CSVParser.quote(value))
+        return literals
+
+    return anonymise
+
+
+# The columns warned about in this process
+_warned = set()
+
+
+def _warn_unanonymised(column):
+    key = (column.name, column.anon_type)
+    if key not in _warned:
+        _warned.add(key)
+        print >>sys.stderr, ('Warning: values of column `%s` which can\'t '
+                             'be anonymised as %s are written as NULL'
+                             % key)
+
+
+def _debug_transform(transform, column):
+    def anonymise(fields):
+        literals = transform(fields)
+        for field, randomised in zip(fields, literals):
+            print >>sys.stderr, ('    ....transmogrifying from value "%s" to '
+                                 'value "%s" with type %s, anon type %s'
+                                 % (field, randomised, column.column_type,
+                                    column.anon_type))
+        return literals
+
+    return anonymise
+
+
+class ColumnPlan(object):
+    """How to anonymise a single column of a table"""
+
+    __slots__ = ('index', 'name', 'column_type', 'anon_type', 'debug',
+                 'transform')
+
+    def __init__(self, index, name, column_type, anon_type, debug=False):
+        self.index = index
+        self.name = name
+        self.column_type = column_type
+        self.anon_type = anon_type
+        self.debug = debug
+
+        # The same value maps to the same output everywhere when randomise
+        # is in keyed mode
+        self.transform = _literal_transform(
+            randomise.get_batch_transform(anon_type), self)
+        if debug:
+            self.transform = _debug_transform(self.transform, self)
+
+    def __reduce__(self):
+        # The transform is a closure which can't be pickled, so have it
+        # rebuilt on the other side instead
+        return (ColumnPlan, (self.index, self.name, self.column_type,
+                             self.anon_type, self.debug))
+
+
+class TablePlan(object):
+    """The columns of a table which need anonymising, compiled once when
+    the table is defined and then run against every row. numeric is the
+    indexes of the table's columns of numeric types."""
+
+    __slots__ = ('table', 'width', 'columns', 'numeric')
+
+    def __init__(self, table, width, columns=(), numeric=()):
+        self.table = table
+        self.width = width
+        self.columns = tuple(columns)
+        self.numeric = frozenset(numeric)
+
+    def __reduce__(self):
+        return (TablePlan, (self.table, self.width, self.columns,
+                            self.numeric))
+
+    def rewrite(self, line, pos=0):
+        """Anonymise the rows of the INSERT statement in line whose VALUES
+        start at pos. Only the fields being anonymised are replaced, the
+        rest of the line is copied across verbatim."""
+
+        if not self.columns:
+            # Nothing to do, so don't even tokenise the rows
+            return line
+
+        rows, columns = self._anonymise(line, pos)
+        return self._splice(line, rows, columns)
+
+    def rewrite_counted(self, line, pos=0):
+        """Like rewrite(), but return how many rows line has as well. The
+        rows are counted even when there's nothing to anonymise."""
+
+        rows, columns = self._anonymise(line, pos)
+        return self._splice(line, rows, columns), len(rows)
+
+    def rewrite_stream(self, line, pos, readline, max_buffer):
+        """Like rewrite(), for an INSERT statement on a line too long to
+        hold at once. line is the part of it read so far, and readline(n)
+        reads up to n more bytes of the line. Rows are anonymised and
+        yielded as they are read, so no more than max_buffer bytes of the
+        statement are ever held, and a row bigger than that is an error."""
+
+        if not self.columns:
+            yield line
+            while not line.endswith('\n'):
+                line = readline(max_buffer)
+                if not line:
+                    return
+                yield line
+            return
+
+        yield line[:pos]
+        for text, rows, columns in self._stream(line, pos, readline,
+                                                max_buffer):
+            if rows is None:
+                yield text
+            else:
+                yield self._splice(text, rows, columns)
+
+    def _stream(self, line, pos, readline, max_buffer):
+        """Read the rows of an INSERT statement a batch at a time, see
+        rewrite_stream(). Yields (text, rows, columns) for each batch, with
+        the field spans of its rows in text and their anonymised literals,
+        and then (text, None, None) for each piece of the line after the
+        last row."""
+
+        buf = line[pos:]
+        finished = False
+        while not buf.endswith('\n'):
+            rows, end, finished = _PARSER.complete_rows(buf)
+            if rows:
+                yield buf[:end], rows, self._transform(buf, rows)
+                buf = buf[end:]
+            if finished:
+                break
+            if len(buf) >= max_buffer:
+                raise ValueError('A row of table %s is bigger than the %d '
+                                 'byte buffer' % (self.table, max_buffer))
+            more = readline(max_buffer - len(buf))
+            if not more:
+                break
+            buf += more
+
+        if not finished:
+            # The rest of the statement is all here now
+            rows = list(_PARSER.row_spans(buf, 0))
+            yield buf, rows, self._transform(buf, rows)
+            return
+        yield buf, None, None
+        while not buf.endswith('\n'):
+            buf = readline(max_buffer)
+            if not buf:
+                return
+            yield buf, None, None
+
+    def _splice(self, line, rows, columns, stop=None):
+        """Put the anonymised literals into line in place of the fields,
+        up to stop"""
+
+        pieces = []
+        append = pieces.append
+        last = 0
+        for row, spans in enumerate(rows):
+            for index, literals in columns:
+                start, end = spans[index]
+                append(line[last:start])
+                append(literals[row])
+                last = end
+
+        append(line[last:stop])
+        return ''.join(pieces)
+
+    def values(self, line, pos=0):
+        """Anonymise the rows of the INSERT statement in line whose VALUES
+        start at pos, returning the bracketed values of each row on its own
+        so that they can be put into statements of a different size."""
+
+        rows, columns = self._anonymise(line, pos)
+        return self._values(line, rows, columns)
+
+    def values_stream(self, line, pos, readline, max_buffer):
+        """Like values(), for an INSERT statement on a line too long to hold
+        at once, see rewrite_stream(). Yields the values of a batch of rows
+        at a time."""
+
+        for text, rows, columns in self._stream(line, pos, readline,
+                                                max_buffer):
+            if rows:
+                yield self._values(text, rows, columns)
+
+    def _values(self, line, rows, columns):
+        values = []
+        for row, spans in enumerate(rows):
+            pieces = ['(']
+            last = spans[0][0]
+            for index, literals in columns:
+                start, end = spans[index]
+                pieces.append(line[last:start])
+                pieces.append(literals[row])
+                last = end
+            pieces.append(line[last:spans[-1][1]])
+            pieces.append(')')
+            values.append(''.join(pieces))
+        return values
+
+    def to_tsv(self, line, pos=0):
+        """Anonymise the rows of the INSERT statement in line whose VALUES
+        start at pos, returning them as lines of tab separated values for
+        LOAD DATA INFILE rather than as SQL."""
+
+        rows, columns = self._anonymise(line, pos)
+        return self._tsv(line, rows, columns)
+
+    def tsv_stream(self, line, pos, readline, max_buffer):
+        """Like to_tsv(), for an INSERT statement on a line too long to hold
+        at once, see rewrite_stream(). Yields the lines of a batch of rows
+        at a time."""
+
+        for text, rows, columns in self._stream(line, pos, readline,
+                                                max_buffer):
+            if rows:
+                yield self._tsv(text, rows, columns)
+
+    def _tsv(self, line, rows, columns):
+        lines = []
+        for row, spans in enumerate(rows):
+            fields = [line[start:end] for start, end in spans]
+            for index, literals in columns:
+                fields[index] = literals[row]
+            lines.append('\t'.join(
+                CSVParser.tsv_field(field, i in self.numeric)
+                for i, field in enumerate(fields)))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def _anonymise(self, line, pos):
+        """Return the field spans of each row of the INSERT statement in
+        line, and the anonymised literals of each column being anonymised"""
+
+        # Multiple rows of the database can be in each INSERT statement
+        rows = list(_PARSER.row_spans(line, pos))
+        return rows, self._transform(line, rows)
+
+    def _transform(self, line, rows):
+        """Return the anonymised literals of each column being anonymised,
+        for the rows with the given field spans in line"""
+
+        if not self.columns:
+            return []
+        for spans in rows:
+            if len(spans) != self.width:
+                raise ValueError('Row of %d fields in table %s with %d '
+                                 'columns' % (len(spans), self.table,
+                                              self.width))
+
+        # Randomise a column of the statement at a time
+        columns = []
+        for column in self.columns:
+            index = column.index
+            fields = [line[spans[index][0]:spans[index][1]] for spans in rows]
+            columns.append((index, column.transform(fields)))
+        return columns
+
+
+# Used for tables we know nothing about, which pass through untouched
+NULL_PLAN = TablePlan(None, None)
+
+
+def compile_plan(table, columns, config, debug=False):
+    """Compile a plan for a table.
+
+    columns is a list of (name, type) tuples in the order the table
+    defines them, and config maps the names of confidential columns to
+    their anonymisation types.
+    """
+    config = config or {}
+    anon_columns = []
+    numeric = []
+    for index, (name, column_type) in enumerate(columns):
+        if _re_numeric_type.match(column_type):
+            numeric.append(index)
+        anon_type = config.get(name)
+        if anon_type:
+            anon_columns.append(ColumnPlan(index, name, column_type,
+                                           anon_type, debug))
+    return TablePlan(table, len(columns), anon_columns, numeric)
@@ -0,0 +1,156 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import fnmatch
+import json
+import os
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+import randomise
+
+
+# Characters which make a table name in a policy a pattern
+_GLOB_CHARS = '*?['
+
+
+def _is_pattern(name):
+    return any(c in name for c in _GLOB_CHARS)
+
+
+class Policy(dict):
+    """A table to column to anonymisation type mapping, as used by the
+    tools, read from a policy file rather than the nova models.
+
+    Tables named outright are ordinary entries. Tables matching one of the
+    glob patterns, such as shadow_*, are worked out the first time they're
+    asked for. The columns of every pattern a table matches are combined,
+    with more specific patterns overriding less specific ones, and then the
+    entry naming the table itself, if any, overrides them all. A column
+    with a type of null is not anonymised, which lets a table opt out of
+    what a pattern says.
+    """
+
+    def __init__(self, tables=(), patterns=()):
+        self._patterns = list(patterns)
+        self._resolved = {}
+        super(Policy, self).__init__()
+        for name, columns in tables:
+            self[name] = self._resolve(name, columns)
+
+    def _resolve(self, name, columns=None):
+        resolved = {}
+        for pattern, pattern_columns in self._patterns:
+            if fnmatch.fnmatchcase(name, pattern):
+                resolved.update(pattern_columns)
+        resolved.update(columns or {})
+        return dict((column, column_type)
+                    for column, column_type in resolved.items()
+                    if column_type is not None)
+
+    def __missing__(self, name):
+        if name not in self._resolved:
+            self._resolved[name] = self._resolve(name) or None
+        if self._resolved[name] is None:
+            raise KeyError(name)
+        return self._resolved[name]
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+
+def _resolve_type(column_type, aliases, where):
+    seen = []
+    while column_type in aliases:
+        if column_type in seen:
+            raise ValueError('%s: type alias loop %s'
+                             % (where, ' -> '.join(seen + [column_type])))
+        seen.append(column_type)
+        column_type = aliases[column_type]
+    if column_type is not None and not randomise.is_known_type(column_type):
+        raise ValueError('%s: unknown anonymisation type %r'
+                         % (where, column_type))
+    return column_type
+
+
+def compile_policy(document, source='policy'):
+    """Check a policy, as read from a file, and compile it into a Policy.
+
+    The policy is a mapping with a "tables" section, which maps table names
+    or glob patterns to mappings of column names to anonymisation types.
+    An optional "types" section defines new types as aliases of others,
+    either directly or as a mapping with a "type" key.
+    """
+    if not isinstance(document, dict):
+        raise ValueError('%s: expected a mapping at the top level' % source)
+    unknown = set(document) - set(['tables', 'types'])
+    if unknown:
+        raise ValueError('%s: unknown sections %s'
+                         % (source, ', '.join(sorted(unknown))))
+
+    aliases = {}
+    for name, options in (document.get('types') or {}).items():
+        if isinstance(options, dict):
+            unknown = set(options) - set(['type'])
+            if unknown or 'type' not in options:
+                raise ValueError('%s: type %s needs exactly a "type" option'
+                                 % (source, name))
+            options = options['type']
+        aliases[name] = options
+
+    tables = []
+    patterns = []
+    for name, columns in sorted((document.get('tables') or {}).items()):
+        where = '%s: table %s' % (source, name)
+        if not isinstance(columns, dict):
+            raise ValueError('%s: expected a mapping of columns' % where)
+        columns = dict((column, _resolve_type(column_type, aliases,
+                                              '%s, column %s'
+                                              % (where, column)))
+                       for column, column_type in columns.items())
+        if _is_pattern(name):
+            patterns.append((name, columns))
+        else:
+            tables.append((name, columns))
+
+    # More specific patterns are applied last, so that they win
+    patterns.sort(key=lambda pattern: (-sum(pattern[0].count(c)
+                                            for c in _GLOB_CHARS),
+                                       len(pattern[0]), pattern[0]))
+    return Policy(tables, patterns)
+
+
+def load_policy(path):
+    """Read a JSON or YAML policy file, depending on its extension"""
+    with open(path) as f:
+        if os.path.splitext(path)[1] in ('.yaml', '.yml'):
+            if yaml is None:
+                raise ValueError('PyYAML is needed to read %s' % path)
+            document = yaml.safe_load(f)
+        else:
+            document = json.load(f)
+    return compile_policy(document, path)
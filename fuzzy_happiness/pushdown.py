@@ -0,0 +1,96 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from sqlalchemy import case, func, literal_column, null, or_
+
+import calendar
+import datetime
+
+
+# SQL expressions which anonymise a column on a MySQL server, for the types
+# simple enough not to need Python. They produce values of the same shape
+# as the matching functions in randomise.
+
+# The range of random_datetime_replacement's years
+_EPOCH = datetime.datetime(1971, 1, 1)
+_SECONDS = (calendar.timegm(datetime.datetime(2014, 1, 1).utctimetuple()) -
+            calendar.timegm(_EPOCH.utctimetuple()))
+
+# How many random hexadecimal digits each SHA2() makes
+_HEX_DIGITS = 64
+
+
+def _datetime(column):
+    return func.timestampadd(literal_column('SECOND'),
+                             func.floor(func.rand() * _SECONDS),
+                             _EPOCH.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def _octet():
+    return func.floor(1 + func.rand() * 254)
+
+
+def _ip_address(column):
+    # Keep the number of octets, like random_ipaddress_replacement
+    dots = (func.char_length(column) -
+            func.char_length(func.replace(column, '.', '')))
+    return case([(dots == octets - 1,
+                  func.concat_ws('.', *[_octet() for _ in range(octets)]))
+                 for octets in (2, 3, 4)],
+                else_=null())
+
+
+def _uuid(column):
+    return func.concat('fake', func.substring(func.uuid(), 6))
+
+
+def _hexstring(column):
+    # Enough independent digits for the longest value the column holds, so
+    # none are repeated. Columns of unlimited length are left to Python.
+    size = getattr(column.type, 'length', None)
+    if not size:
+        return None
+    digits = func.concat(*[func.sha2(func.rand(), 256)
+                           for _ in range(-(-size // _HEX_DIGITS))])
+    return func.substring(digits, 1, func.char_length(column))
+
+
+_EXPRESSIONS = {
+    'datetime': _datetime,
+    'ip_address': _ip_address,
+    'ip_address_v4': _ip_address,
+    'uuid': _uuid,
+    'hexstring': _hexstring,
+}
+
+
+def supports(engine):
+    """Whether expressions can be pushed down to engine's database"""
+    return engine.dialect.name == 'mysql'
+
+
+def expression_for(column, column_type):
+    """Return an expression to anonymise column on the server, or None if
+    column_type needs doing in Python. Special values are left alone, as
+    randomise.randomness does."""
+    make = _EXPRESSIONS.get(column_type)
+    if make is None:
+        return None
+    expression = make(column)
+    if expression is None:
+        return None
+    special = or_(column.is_(None),
+                  func.trim(column) == literal_column("''"),
+                  column == literal_column("'NULL'"))
+    return case([(special, column)], else_=expression)
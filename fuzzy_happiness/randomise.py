@@ -12,17 +12,26 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import array
+import binascii
+import hashlib
+import hmac
 import json
 import random
+import re
 import string as st
+import threading
 import uuid
 
+from oslo.config import cfg
+
 _LOWERCASE_LETTERS = list(st.ascii_lowercase)
 _UPPERCASE_LETTERS = list(st.ascii_uppercase)
 _NUMERIC = list(st.digits)
 _SYMBOLIC = list('!@#$%^&*()_-~`"\',./<>?:;\\|[]{}')
 _WHITESPACE = list(st.whitespace)
 _ANY = _LOWERCASE_LETTERS + _UPPERCASE_LETTERS + _NUMERIC + _SYMBOLIC
+_ANY_TUPLE = tuple(_ANY)
 _REPLACEMENT_DICTIONARY = {
     'lowercase_letters': (_LOWERCASE_LETTERS, _LOWERCASE_LETTERS),
     'uppercase_letters': (_UPPERCASE_LETTERS, _UPPERCASE_LETTERS),
@@ -30,19 +39,129 @@ _REPLACEMENT_DICTIONARY = {
     'symbolic': (_SYMBOLIC, _SYMBOLIC),
     'whitespace': (_WHITESPACE, None)
 }
+# Padding is drawn from _ANY, like characters no class knows about
+_PADDING_DICTIONARY = {}
+_HEX_DICTIONARY = {
+    'hex': (list(st.hexdigits), list(st.hexdigits))
+}
 
 
-def random_char_replacement(character=None,
-                            replacement_dictionary=_REPLACEMENT_DICTIONARY):
-    if character is not None:
+class _State(threading.local):
+    # Where random numbers come from. Normally this is the random module's
+    # shared generator, so that random.seed() works, but in keyed mode each
+    # value gets a generator of its own seeded from the value itself.
+    rng = random
+
+
+_state = _State()
+_secret = None
+
+# The option of each tool which turns keyed mode on
+secret_opt = cfg.StrOpt('secret',
+                        default=None,
+                        secret=True,
+                        help=('Anonymise deterministically, keyed by this '
+                              'secret, so that the same value always maps '
+                              'to the same output. Best set in a config '
+                              'file rather than on the command line.'))
+
+
+def set_secret(secret):
+    """Switch to keyed mode, or back out of it if secret is None.
+
+    In keyed mode the random numbers used to anonymise a value are derived
+    from an HMAC of the anonymisation type and the value, so the same input
+    always maps to the same output, in any table, process or run which
+    uses the same secret. Nothing needs to be shared to keep foreign keys
+    and joined values consistent.
+    """
+    global _secret
+    _secret = secret
+
+
+def _keyed(transform, column_type, value):
+    """Run transform on value with a generator seeded from the value"""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    digest = hmac.new(_secret, '%s\0%s' % (column_type, value),
+                      hashlib.sha256).hexdigest()
+    previous = _state.rng
+    _state.rng = random.Random(long(digest, 16))
+    try:
+        return transform(value)
+    finally:
+        _state.rng = previous
+
+
+# Replacement dictionaries are compiled into character lookup tables the
+# first time they're used, and are assumed not to change after that
+_TABLE_CACHE_SIZE = 64
+_tables = {}
+
+
+class _CharTable(object):
+    """A replacement dictionary compiled into a lookup table mapping each
+    character to the tuple of characters it may be replaced with, or to
+    None if it is kept as is."""
+
+    __slots__ = ('lookup',)
+
+    def __init__(self, replacement_dictionary):
+        self.lookup = {}
+        # The first class a character appears in wins
         for search, replace in replacement_dictionary.values():
-            if character in search:
+            if replace is not None:
+                replace = tuple(replace)
+            for character in search:
+                self.lookup.setdefault(character, replace)
+
+    def replace_all(self, strings):
+        """Randomise every character of every string in strings, drawing
+        all the random numbers needed in one go"""
+        lookup = self.lookup
+        words = _random_words(sum(len(string) for string in strings))
+        pos = 0
+        results = []
+        for string in strings:
+            out = []
+            append = out.append
+            for character in string:
+                replace = lookup.get(character, _ANY_TUPLE)
                 if replace is None:
-                    # Do no replace this character with anything
-                    return character
-                return random.choice(replace)
+                    append(character)
+                else:
+                    append(replace[words[pos] % len(replace)])
+                pos += 1
+            results.append(''.join(out))
+        return results
+
+
+def _table_for(replacement_dictionary):
+    entry = _tables.get(id(replacement_dictionary))
+    if entry is None or entry[0] is not replacement_dictionary:
+        if len(_tables) >= _TABLE_CACHE_SIZE:
+            _tables.clear()
+        # Keep a reference to the dictionary so its id can't be reused
+        entry = (replacement_dictionary, _CharTable(replacement_dictionary))
+        _tables[id(replacement_dictionary)] = entry
+    return entry[1]
+
+
+def _random_words(count):
+    """Draw count random 16 bit numbers at once, rather than making a call
+    into random for each one. The modulo bias when these are used to pick
+    from a few dozen characters is negligible."""
+    if not count:
+        return ()
+    bits = _state.rng.getrandbits(16 * count)
+    return array.array('H', binascii.unhexlify('%0*x' % (4 * count, bits)))
+
 
-    return random.choice(_ANY)
+def random_char_replacement(character=None,
+                            replacement_dictionary=_REPLACEMENT_DICTIONARY):
+    if character is None:
+        return _state.rng.choice(_ANY)
+    return _table_for(replacement_dictionary).replace_all([character])[0]
 
 
 def random_str_replacement(string,
@@ -56,45 +175,37 @@ def random_str_replacement(string,
     if string is None:
         return None
 
-    string = list(str(string))
-
-    for i, char in enumerate(string):
-        string[i] = random_char_replacement(
-            char, replacement_dictionary=replacement_dictionary)
-
-    for i in range(padding_before):
-        string = random_char_replacement(
-            replacement_dictionary=replacement_dictionary) + string
-
-    for i in range(padding_after):
-        string = string + random_char_replacement(
-            replacement_dictionary=replacement_dictionary)
+    if not isinstance(string, basestring):
+        string = str(string)
 
-    return ''.join(string)
+    string = _table_for(replacement_dictionary).replace_all([string])[0]
+    if padding_before or padding_after:
+        padding = _table_for(_PADDING_DICTIONARY).replace_all(
+            ['x' * padding_before, 'x' * padding_after])
+        string = padding[0] + string + padding[1]
+    return string
 
 
 def random_hexstring_replacement(string, padding_before=0, padding_after=0):
     """Randomise each character in a hexadecimal string"""
-    replacement_dict = {
-        'hex': (list(st.hexdigits), list(st.hexdigits))
-    }
-    return random_str_replacement(string, replacement_dict,
+    return random_str_replacement(string, _HEX_DICTIONARY,
                                   padding_before, padding_after)
 
 
+# Note(mrda): Everything but /, \ and whitespace (while whitespace is
+# allowed in pathnames, it can prove diffficult to manage, so we won't
+# allow it for anonymisation
+_PATHNAME_CHARS = (st.ascii_letters + st.digits +
+                   '!@#$%^&*()~`"\',<>?:;|[]{}')
+_PATHNAME_DICTIONARY = _REPLACEMENT_DICTIONARY.copy()
+_PATHNAME_DICTIONARY['symbolic'] = (_PATHNAME_CHARS, _PATHNAME_CHARS)
+_PATHNAME_DICTIONARY['keep'] = (list('.-_/\\'), None)
+
+
 def random_pathname_replacement(string, padding_before=0, padding_after=0):
     """Randomise files and directories for a path, preserving directory
        structure"""
-    # Note(mrda): Everything but /, \ and whitespace (while whitespace is
-    # allowed in pathnames, it can prove diffficult to manage, so we won't
-    # allow it for anonymisation
-    allowed_chars = (st.ascii_letters + st.digits +
-                     '!@#$%^&*()~`"\',<>?:;|[]{}')
-
-    replacement_dict = _REPLACEMENT_DICTIONARY.copy()
-    replacement_dict['symbolic'] = (allowed_chars, allowed_chars)
-    replacement_dict['keep'] = (list('.-_/\\'), None)
-    return random_str_replacement(string, replacement_dict,
+    return random_str_replacement(string, _PATHNAME_DICTIONARY,
                                   padding_before, padding_after)
 
 
@@ -107,19 +218,19 @@ def random_ipaddress_replacement(string, padding_before=0, padding_after=0):
         return None
     candidates = []
     for i in range(num_octets):
-        octet = str(random.randint(1, 254))
+        octet = str(_state.rng.randint(1, 254))
         candidates.append(octet)
     return ".".join(candidates)
 
 
 def random_datetime_replacement(string):
     """Randomise a datetime string"""
-    year = random.randint(1971, 2013)
-    month = random.randint(1, 12)
-    day = random.randint(1, 28)  # cheat
-    hour = random.randint(0, 59)
-    minute = random.randint(0, 59)
-    second = random.randint(0, 59)
+    year = _state.rng.randint(1971, 2013)
+    month = _state.rng.randint(1, 12)
+    day = _state.rng.randint(1, 28)  # cheat
+    hour = _state.rng.randint(0, 59)
+    minute = _state.rng.randint(0, 59)
+    second = _state.rng.randint(0, 59)
     return ("%04d-%02d-%02d %02d:%02d:%02d" %
            (year, month, day, hour, minute, second))
 
@@ -144,19 +255,199 @@ def random_json_replacement(string):
     return json.dumps(json_obj)
 
 
+# Valid hostname chars, according to RFC1123, is approximately
+# ([0-9a-z][0-9a-z\-]{0-62})(\.[0-9a-z][0-9a-z\-]{0-62})+
+# We'll simplify here
+_HOSTNAME_CHARS = list('abcdefghijklmnopqrstuvwxyz0123456789')
+_HOSTNAME_DICTIONARY = {
+    'hostname': (_HOSTNAME_CHARS, _HOSTNAME_CHARS),
+    'whitespace': (_WHITESPACE, None),
+    'keep': (list('-.'), None)
+}
+
+
 def random_hostname_replacement(string):
     """Randomise a hostname"""
-    # Valid hostname chars, according to RFC1123, is approximately
-    # ([0-9a-z][0-9a-z\-]{0-62})(\.[0-9a-z][0-9a-z\-]{0-62})+
-    # We'll simplify here
-    allowed_chars = list('abcdefghijklmnopqrstuvwxyz0123456789')
-    keep_chars = list('-.')
-    replacement_dict = {
-        'hostname': (allowed_chars, allowed_chars),
-        'whitespace': (_WHITESPACE, None),
-        'keep': (keep_chars, None)
-    }
-    return random_str_replacement(string, replacement_dict)
+    return random_str_replacement(string, _HOSTNAME_DICTIONARY)
+
+
+def random_uuid_replacement(string):
+    """Replace a uuid with an obviously fake one of the same format"""
+    # Drawn from random rather than uuid4() so that seeding works
+    return 'fake%s' % str(uuid.UUID(int=_state.rng.getrandbits(128),
+                                    version=4))[5:]
+
+
+def random_float_replacement(string):
+    """Randomise the digits of a float, keeping the decimal point"""
+    return random_str_replacement(string,
+                                  replacement_dictionary=_FLOAT_DICTIONARY)
+
+
+# The unquoted literals of a dump: decimal numbers, and hexadecimal ones
+_NUMBER_RE = re.compile(r'(?:(0x)([0-9a-fA-F]+)|'
+                        r'([-+]?)([0-9]+\.?[0-9]*|\.[0-9]+)'
+                        r'([eE][-+]?[0-9]+)?)$')
+
+
+def is_number(string):
+    """Whether string is a numeric or 0x hexadecimal SQL literal"""
+    return bool(_NUMBER_RE.match(string))
+
+
+def random_number_replacement(string):
+    """Randomise the digits of a number, keeping its sign, decimal point and
+       exponent, or the hexadecimal digits of a 0x literal"""
+    m = _NUMBER_RE.match(string)
+    if not m:
+        return random_str_replacement(string)
+    if m.group(1):
+        return m.group(1) + random_str_replacement(m.group(2),
+                                                   _HEX_DICTIONARY)
+    digits = random_str_replacement(m.group(4), _FLOAT_DICTIONARY)
+    return m.group(3) + digits + (m.group(5) or '')
+
+
+def random_symbolic_hostname_replacement(string):
+    """Randomise a hostname, keeping its separators but allowing symbols"""
+    return random_str_replacement(
+        string, replacement_dictionary=_SYMBOLIC_HOSTNAME_DICTIONARY)
+
+
+def random_any_replacement(string):
+    """Randomise a value of unknown type"""
+    if string[0] == '{':
+        # If it looks like json...
+        return random_json_replacement(string)
+    return random_str_replacement(string)
+
+
+def _no_replacement(string):
+    return string
+
+
+_FLOAT_DICTIONARY = {
+    'numeric': (_NUMERIC, _NUMERIC),
+    'symbolic': (list('.'), None)
+}
+_SYMBOLIC_HOSTNAME_DICTIONARY = _REPLACEMENT_DICTIONARY.copy()
+_SYMBOLIC_HOSTNAME_DICTIONARY['symbolic'] = (
+    list('!@#$%^&*()~`"\',/<>?:;\\|[]{}'), _SYMBOLIC)
+_SYMBOLIC_HOSTNAME_DICTIONARY['keep'] = (list('.-_'), None)
+
+# Note(mrda): TODO: The following types are not yet implemented here:
+#     ec2_id
+#     integer
+#     ip_addesss_v6
+#     key_name
+_TRANSFORMS = {
+    'uuid': random_uuid_replacement,
+    # Note(mikal): Possibly make this smarter to keep subnet classes
+    'ip_address': random_ipaddress_replacement,
+    'ip_address_v4': random_ipaddress_replacement,
+    # Note(mrda): TODO: implement V6
+    'ip_address_v6': _no_replacement,
+    'hexstring': random_hexstring_replacement,
+    'hostname': random_symbolic_hostname_replacement,
+    'varchar': random_str_replacement,
+    'text': random_str_replacement,
+    'mediumtext': random_str_replacement,
+    'bigint': random_str_replacement,
+    'tinyint': random_str_replacement,
+    'int': random_str_replacement,
+    'long': random_str_replacement,
+    'float': random_float_replacement,
+    'datetime': random_datetime_replacement,
+    'number': random_number_replacement,
+}
+
+
+# Types which are randomised purely by character substitution, so can have
+# a whole column's worth of values done at once
+_TABLE_TYPES = {
+    'hexstring': _HEX_DICTIONARY,
+    'hostname': _SYMBOLIC_HOSTNAME_DICTIONARY,
+    'varchar': _REPLACEMENT_DICTIONARY,
+    'text': _REPLACEMENT_DICTIONARY,
+    'mediumtext': _REPLACEMENT_DICTIONARY,
+    'bigint': _REPLACEMENT_DICTIONARY,
+    'tinyint': _REPLACEMENT_DICTIONARY,
+    'int': _REPLACEMENT_DICTIONARY,
+    'long': _REPLACEMENT_DICTIONARY,
+    'float': _FLOAT_DICTIONARY,
+}
+
+
+def _is_special(value):
+    """Values which are left alone, whatever their type"""
+    return (value is None or
+            (isinstance(value, basestring) and
+             (value == 'NULL' or value.strip() == "")))
+
+
+def is_known_type(column_type):
+    """Whether column_type has an anonymiser of its own, rather than being
+    treated as a value of unknown type"""
+    return column_type in _TRANSFORMS
+
+
+def get_transform(column_type):
+    """Return a function which randomises a single value of column_type.
+
+    Looking the transform up once and calling it for every value avoids
+    dispatching on column_type for each value.
+    """
+    transform = _TRANSFORMS.get(column_type, random_any_replacement)
+
+    def anonymise(old_value):
+        # Special case randomisations
+        if _is_special(old_value):
+            return old_value
+        if _secret is not None:
+            return _keyed(transform, column_type, old_value)
+        return transform(old_value)
+
+    return anonymise
+
+
+def get_batch_transform(column_type):
+    """Return a function which randomises a list of values of column_type,
+    returning a list of the new values."""
+    replacement_dictionary = _TABLE_TYPES.get(column_type)
+    if replacement_dictionary is None:
+        transform = get_transform(column_type)
+
+        def anonymise(values):
+            return [transform(value) for value in values]
+
+        return anonymise
+
+    table = _table_for(replacement_dictionary)
+    keyed = get_transform(column_type)
+
+    def anonymise(values):
+        if _secret is not None:
+            # Every value needs a generator of its own
+            return [keyed(value) for value in values]
+
+        results = list(values)
+        indexes = [i for i, value in enumerate(results)
+                   if not _is_special(value)]
+        randomised = table.replace_all(
+            [results[i] if isinstance(results[i], basestring)
+             else str(results[i]) for i in indexes])
+        for i, value in zip(indexes, randomised):
+            results[i] = value
+        return results
+
+    return anonymise
+
+
+def randomness_batch(values, column_type):
+    """Generate random values for a whole column slice at once, depending
+       on the column_type and using the old values as a reference for length
+       and type"""
+    return get_batch_transform(column_type)(values)
 
 
 def randomness(old_value, column_type):
@@ -164,50 +455,9 @@ def randomness(old_value, column_type):
        old value as a reference for length and type"""
 
     # Special case randomisations
-    if old_value == 'NULL' or old_value.strip() == "":
+    if _is_special(old_value):
         return old_value
-    if column_type == 'uuid':
-        new_uuid = "'fake%s'" % str(uuid.uuid4())[5:]
-        return new_uuid
-
-    # Note(mrda): TODO: The following types are not yet implemented here:
-    #     ec2_id
-    #     integer
-    #     ip_addesss_v6
-    #     key_name
-    if (column_type == 'ip_address_v4' or
-        column_type == 'ip_address'):
-        # Note(mikal): Possibly make this smarter to keep subnet classes
-        return random_ipaddress_replacement(old_value)
-    elif column_type == 'ip_address_v6':
-        # Note(mrda): TODO: implement V6
-        return old_value
-    elif column_type == 'hexstring':
-        return random_str_replacement(old_value, keep_hexadecimal=True)
-    elif column_type == 'hostname':
-        replacement_dict = _REPLACEMENT_DICTIONARY.copy()
-        replacement_dict['symbolic'] = (list('!@#$%^&*()~`"\',/<>?:;\\|[]{}'),
-                                        _SYMBOLIC)
-        replacement_dict['keep'] = (list('.-_'), None)
-        return random_str_replacement(old_value,
-                                      replacement_dictionary=replacement_dict)
-    elif column_type in ('varchar', 'text', 'mediumtext'):
-        return random_str_replacement(old_value)
-    elif column_type in ('bigint', 'tinyint', 'int', 'long'):
-        return random_str_replacement(old_value)
-    elif column_type == 'float':
-        replacement_dict = {
-            'numeric': (_NUMERIC, _NUMERIC),
-            'symbolic': (list('.'), None)
-        }
-        return random_str_replacement(old_value,
-                                      replacement_dictionary=replacement_dict)
-    elif column_type == 'datetime':
-        return random_datetime_replacement(old_value)
-    elif column_type == 'hostname':
-        return random_hostname_replacement(old_value)
-    elif old_value[0] == '{':
-        # If it looks like json...
-        return random_json_replacement(old_value)
-    else:
-        return random_str_replacement(old_value)
+    transform = _TRANSFORMS.get(column_type, random_any_replacement)
+    if _secret is not None:
+        return _keyed(transform, column_type, old_value)
+    return transform(old_value)
@@ -25,8 +25,11 @@
 #    types :)
 #
 
-import CSVParser
-import os
+import fileio
+import output
+import parallel
+import plans
+import random
 import randomise
 import re
 import sys
@@ -46,6 +49,49 @@ opts = [
 ]
 CONF.register_opts(opts)
 
+cli_opts = [
+    output.output_opt,
+    cfg.StrOpt('format',
+               default='sql',
+               choices=output.FORMATS,
+               help=('Write the anonymised dump as SQL, or as tsv: a '
+                     'directory of schema.sql, a tab separated data file '
+                     'per table, and load.sql to load them with LOAD DATA '
+                     'INFILE, or as a directory in the layout mydumper '
+                     'writes, for myloader.')),
+    cfg.IntOpt('rows_per_insert',
+               default=0,
+               help=('Write INSERT statements of at most this many rows, '
+                     'rather than as many as each statement of the input '
+                     'had. 0 means no limit.')),
+    cfg.IntOpt('max_statement_bytes',
+               default=0,
+               help=('Write INSERT statements of at most this many bytes, '
+                     'e.g. to fit the max_allowed_packet of the server '
+                     'they are loaded into. 0 means no limit.')),
+    cfg.IntOpt('chunk_rows',
+               default=1000000,
+               help=('How many rows to put in each data file of mydumper '
+                     'output. Files are split between INSERT statements, '
+                     'so they may hold a statement\'s worth more.')),
+    parallel.workers_opt,
+    cfg.IntOpt('max_buffer',
+               default=64 * 1024 * 1024,
+               help=('The most bytes of a line to hold in memory. INSERT '
+                     'statements on longer lines are anonymised a few rows '
+                     'at a time as they are read, and a single row longer '
+                     'than this is an error. How the rows are grouped '
+                     'changes which random values they get, so with --seed '
+                     'the output depends on this too, unlike with '
+                     '--secret.')),
+    cfg.IntOpt('seed',
+               default=None,
+               help=('Seed for the random number generator, making output '
+                     'reproducible.')),
+    randomise.secret_opt,
+]
+CONF.register_cli_opts(cli_opts)
+
 
 #
 # SQL by regular expressions
@@ -63,7 +109,7 @@ _re_table_index = re.compile(r'^\s*`(?P<index_name>([A-Za-z_0-9]+))`\s+'
 _re_unneeded_table_sql = re.compile(r'^\s*((PRIMARY\sKEY)|(KEY)|(CONSTRAINT)|'
                                     r'(UNIQUE\sKEY))')
 _re_insert = re.compile(r'^\s*INSERT\sINTO\s`(?P<table_name>([A-Za-z_0-9]+))`'
-                        r'\sVALUES\s(?P<insert_values>(.*));')
+                        r'\sVALUES\s*')
 
 _UNDEF = "UNDEFINED"
 
@@ -75,6 +121,7 @@ class Fuzzer(object):
         self.cur_table_index = 0
         self.schema = {}
         self.type_table = {}
+        self.plans = {}
 
     def process_line(self, line):
         """ Process each line in a mini state machine """
@@ -83,7 +130,7 @@ class Fuzzer(object):
         if (_re_blanks.match(line) or _re_comments.match(line) or
             _re_sql_I_dont_care_about.match(line)):
             if CONF.debug:
-                print '    ...unimportant line'
+                print >>sys.stderr, '    ...unimportant line'
             return line
 
         # Find tables to build indexes
@@ -93,7 +140,7 @@ class Fuzzer(object):
             if self.cur_table_index not in self.schema:
                 self.schema[self.cur_table_name] = {}
             if CONF.debug:
-                print '    ...table definition starts'
+                print >>sys.stderr, '    ...table definition starts'
             return line
 
         # Once we're in a table definition, get the row definitions
@@ -101,7 +148,7 @@ class Fuzzer(object):
             # Skip table defns I don't care about
             if _re_unneeded_table_sql.match(line):
                 if CONF.debug:
-                    print '    ...non-column table definition'
+                    print >>sys.stderr, '    ...non-column table definition'
                 return line
 
             m = _re_table_index.search(line)
@@ -115,8 +162,9 @@ class Fuzzer(object):
                 self.type_table[m.group("index_type")] += 1
 
                 if CONF.debug:
-                    print '    ...schema: %s = %s' % (m.group("index_name"),
-                                                      m.group("index_type"))
+                    print >>sys.stderr, ('    ...schema: %s = %s'
+                                         % (m.group("index_name"),
+                                            m.group("index_type")))
                 return line
 
         # Find the end of tables
@@ -138,10 +186,13 @@ class Fuzzer(object):
                            self.schema[self.cur_table_name][idx]['type'],
                            anon_str))
 
+            self.plans[self.cur_table_name] = self._compile_plan(
+                self.cur_table_name)
+
             self.cur_table_name = _UNDEF
             self.cur_table_index = 0
             if CONF.debug:
-                print '    ...end of table definition'
+                print >>sys.stderr, '    ...end of table definition'
 
             if additional:
                 line += '\n%s\n\n' % '\n'.join(additional)
@@ -152,98 +203,226 @@ class Fuzzer(object):
         # of scum and villainy.
         #
         # Also where the data is that needs anonymising is
-        m = _re_insert.search(line)
+        m = _re_insert.match(line)
         if m:
             if CONF.debug:
-                print '    ...data bearing line'
-            return self._parse_insert_data(m.group("table_name"),
-                                           m.group("insert_values"),
-                                           line)
-
-    def _parse_insert_data(self, table, values, line):
-        """ Parse INSERT values, anonymising where required """
-
-        anon_elems = []
-
-        # Multiple rows of the database can be in each INSERT statement
-        elems = re.split('\),\(', values)
-
-        i = 0
-        for elem in elems:
-            if elem[0] == '(':
-                elem = elem[1:]
-            if elem[-1] == ')':
-                elem = elem[:-1]
-
-            # Each elem is an insert statement across a row
-            # of the schema.  Process these rows independently
-            anon_elems.append(self._parse_insert_row_data(table, elem, line))
-
-            i += 1
-
-        anonymised_str = '),\n    ('.join(anon_elems)
-        return ('INSERT INTO `' + table + '` VALUES \n    (' +
-                anonymised_str + ');\n')
-
-    def _parse_insert_row_data(self, table, str, line):
-        """ Parse a single row of a database table from an INSERT statement,
-            anonymising data where required """
-        csv = CSVParser.CSVParser()
-        elems = csv.parse(str)
-        return self._anonymise(elems, table, line)
-
-    def _anonymise(self, fields, table, line):
-        """ Anonymise the supplied fields if this table needs anonymising """
-        if table in self.anon_fields:
-            # Loop through all fields for this line
-            for index, elem in enumerate(fields):
-                field_name = self.schema[table][index]['name']
-                # Check to see if this is a field to be anonymised
-                if field_name in self.anon_fields[table]:
-                    fields[index] = self._transmogrify(
-                        elem,
-                        self.schema[table][index]['type'],
-                        self.anon_fields[table][field_name])
-        return ",".join(fields)
-
-    def _transmogrify(self, string, coltype, anontype):
-        """ Anonymise the provided string, based upon it's type """
-        # Note(mrda): TODO: handle mapping
-
-        # Handle quoted strings
-        need_single_quotes = False
-        if string[0] == "'" and string[-1] == "'":
-            need_single_quotes = True
-            string = string[1:-1]
-
-        randomised = randomise.randomness(string, anontype)
+                print >>sys.stderr, '    ...data bearing line'
+            return self._parse_insert_data(m.group("table_name"), line,
+                                           m.end())
 
+        # Anything else, such as the USE and CREATE DATABASE statements of
+        # a dump made with --databases, is copied as it is
         if CONF.debug:
-            print ('    ....transmogrifying from value "%s" to value "%s"'
-                   ' with type %s, anon type %s'
-                   % (string, randomised, coltype, anontype))
-
-        if need_single_quotes:
-            randomised = "'" + randomised + "'"
-
-        return randomised
+            print >>sys.stderr, '    ...unrecognised line'
+        return line
+
+    def _parse_insert_data(self, table, line, pos):
+        """ Parse INSERT values starting at pos in line, anonymising where
+            required """
+        return _convert(table, self.plan_for(table), line, pos)
+
+    def _compile_plan(self, table):
+        """ Compile the anonymisation plan for a table we've just seen the
+            definition of """
+        schema = self.schema[table]
+        columns = [(schema[index]['name'], schema[index]['type'])
+                   for index in sorted(schema)]
+        return plans.compile_plan(table, columns, self.anon_fields.get(table),
+                                  debug=CONF.debug)
+
+    def plan_for(self, table):
+        """ The anonymisation plan for INSERTs into table. Tables with no
+            anonymisation configured are copied as they are even if we
+            haven't seen their definition, but a table which should be
+            anonymised can't be without it """
+        plan = self.plans.get(table)
+        if plan is not None:
+            return plan
+        if self.anon_fields.get(table):
+            raise ValueError('Table `%s` has fields to anonymise, but its '
+                             'INSERTs come before any CREATE TABLE for it, '
+                             'so its columns are unknown. Dumps made with '
+                             '--no-create-info can\'t be anonymised.'
+                             % table)
+        return plans.NULL_PLAN
+
+    def insert_task(self, line):
+        """ If line is an INSERT needing anonymisation, return everything a
+            worker process needs to do that without the rest of our state,
+            else None """
+        m = _re_insert.match(line)
+        if not m:
+            return None
+        table = m.group("table_name")
+        plan = self.plan_for(table)
+        if not plan.columns and CONF.format == 'sql' and not _rebatching():
+            return None
+        return table, plan, line, m.end()
+
+    def process_long_line(self, line, r):
+        """ Process a line longer than --max_buffer, of which line is the
+            start, and the rest is still to be read from r. Returns the
+            output in pieces. INSERTs are anonymised as they are read, but
+            anything else is read in full and processed as usual """
+        m = _re_insert.match(line)
+        if m:
+            table = m.group("table_name")
+            return _convert_stream(table, self.plan_for(table), line,
+                                   m.end(), r.readline)
+        return [self.process_line(line + r.readline())]
+
+    def passthrough_prefix(self, line):
+        """ If line is an INSERT into a table with nothing to anonymise,
+            return its INSERT INTO prefix, which the lines following it for
+            the same table will share, else None """
+        m = _re_insert.match(line)
+        if not m or CONF.format != 'sql' or _rebatching():
+            return None
+        if self.plan_for(m.group("table_name")).columns:
+            return None
+        return line[:m.end()]
 
     def dump_stats(self, filename):
-        print "\nStatistics for file `" + filename + "`\n"
+        print >>sys.stderr, "\nStatistics for file `" + filename + "`\n"
         # Traverse the self.schema
-        print "Table Statistics"
+        print >>sys.stderr, "Table Statistics"
         for table in self.schema:
-            print ("Table `" + table + "` has " +
-                   str(len(self.schema[table])) + " rows.")
+            print >>sys.stderr, ("Table `" + table + "` has " +
+                                 str(len(self.schema[table])) + " rows.")
         # Print the type table
-        print "\nTypes found in SQL Schema"
+        print >>sys.stderr, "\nTypes found in SQL Schema"
         for key in self.type_table:
-            print key, "appears", self.type_table[key], "times"
+            print >>sys.stderr, key, "appears", self.type_table[key], "times"
+
+
+def _seed_line(lineno):
+    """ Reseed the random number generator for a given input line, so that
+        a line anonymises the same way whichever process handles it """
+    if CONF.seed is not None:
+        random.seed(CONF.seed * 2 ** 64 + lineno)
+
+
+def _rebatching():
+    """ Whether INSERT statements are being split up or merged """
+    return bool(CONF.rows_per_insert or CONF.max_statement_bytes)
+
+
+def _convert(table, plan, line, pos):
+    """ Anonymise an INSERT line with plan, in the output format """
+    if CONF.format == 'sql' and _rebatching():
+        return output.Values(table, line[:pos], plan.values(line, pos))
+    if CONF.format == 'tsv':
+        return output.Rows(table, plan.to_tsv(line, pos))
+    if CONF.format == 'mydumper':
+        data, rows = plan.rewrite_counted(line, pos)
+        return output.Rows(table, data, rows)
+    return plan.rewrite(line, pos)
+
+
+def _convert_stream(table, plan, line, pos, readline):
+    """ Like _convert(), for an INSERT line longer than --max_buffer, of
+        which line is the start and readline() reads the rest. Rows are
+        converted a batch at a time as they are read """
+    if CONF.format == 'sql' and not _rebatching():
+        return plan.rewrite_stream(line, pos, readline, CONF.max_buffer)
+    if CONF.format == 'tsv':
+        return (output.Rows(table, data)
+                for data in plan.tsv_stream(line, pos, readline,
+                                            CONF.max_buffer))
+
+    batches = plan.values_stream(line, pos, readline, CONF.max_buffer)
+    if CONF.format == 'mydumper':
+        # Each batch becomes a statement of its own, so that a data file
+        # can end after any of them
+        return (output.Rows(table, '%s%s;\n' % (line[:pos], ','.join(values)),
+                            len(values)) for values in batches)
+    return (output.Values(table, line[:pos], values) for values in batches)
+
+
+def _process_insert(task):
+    """ Anonymise an INSERT line in a worker process """
+    lineno, (table, plan, line, pos) = task
+    _seed_line(lineno)
+    return _convert(table, plan, line, pos)
+
+
+def _passthrough(fuzz, line, r):
+    """ Yield the lines after line which can be copied as they are, in
+        chunks """
+    prefix = fuzz.passthrough_prefix(line)
+    if prefix:
+        for chunk in fileio.read_while(r, prefix):
+            yield chunk
+
+
+def _lines(r):
+    """ The lines of r, where a line longer than --max_buffer is cut short
+        and the rest is left to be read """
+    # Not iterating over r, whose read ahead would stop _passthrough() from
+    # working
+    return iter(lambda: r.readline(CONF.max_buffer), '')
+
+
+def _debug_line(line, processed):
+    print >>sys.stderr, '>>> %s' % line.rstrip()
+    if isinstance(processed, str):
+        print >>sys.stderr, '<<< %s' % processed.rstrip()
+    else:
+        print >>sys.stderr, '<<< rows of %s' % processed.table
+
+
+def _is_long(line):
+    return len(line) == CONF.max_buffer and not line.endswith('\n')
+
+
+def _insert_tasks(fuzz, r):
+    """ The reader stage: DDL is handled here, INSERTs go to the pool """
+    lineno = 0
+    for line in _lines(r):
+        if _is_long(line):
+            # Too big to send to a worker
+            _seed_line(lineno)
+            for data in fuzz.process_long_line(line, r):
+                yield None, data
+        else:
+            task = fuzz.insert_task(line)
+            if task:
+                yield _process_insert, (lineno, task)
+            else:
+                yield None, fuzz.process_line(line)
+        lineno += 1
+        for chunk in _passthrough(fuzz, line, r):
+            yield None, chunk
+            lineno += chunk.count('\n')
+
+
+def _anonymise(fuzz, r, w):
+    """ Anonymise the dump in r, writing it to w """
+    if CONF.workers > 1:
+        parallel.ordered_pipeline(_insert_tasks(fuzz, r), w.write,
+                                  CONF.workers)
+        return
+
+    lineno = 0
+    for line in _lines(r):
+        _seed_line(lineno)
+        if _is_long(line):
+            for data in fuzz.process_long_line(line, r):
+                w.write(data)
+        else:
+            processed = fuzz.process_line(line)
+            if CONF.debug:
+                _debug_line(line, processed)
+            w.write(processed)
+        lineno += 1
+        for chunk in _passthrough(fuzz, line, r):
+            w.write(chunk)
+            lineno += chunk.count('\n')
 
 
 filename_opt = cfg.StrOpt('filename',
                           default=None,
-                          help='The filename to process',
+                          help='The filename to process, or - for stdin',
                           positional=True)
 
 
@@ -252,31 +431,49 @@ def main():
     CONF(sys.argv[1:], project='fuzzy-happiness')
 
     if not CONF.filename:
-        print 'Please specify a filename to process'
+        print >>sys.stderr, 'Please specify a filename to process'
         return 1
 
-    print "Processing '%s'" % CONF.filename
-    if not os.path.exists(CONF.filename):
-        print 'Input file %s does not exist!' % CONF.filename
-        return 1
-    if not os.path.isfile(CONF.filename):
-        print 'Input %s is not a file!' % CONF.filename
+    print >>sys.stderr, "Processing '%s'" % CONF.filename
+    error = fileio.check_input(CONF.filename)
+    if error:
+        print >>sys.stderr, error
         return 1
 
-    # Load attributes from models.py
-    anon_fields = attributes.load_configuration()
+    if CONF.secret:
+        randomise.set_secret(CONF.secret)
+
+    # Load attributes from models.py, or a policy file
+    try:
+        anon_fields = attributes.get_configuration()
+    except (ImportError, IOError, ValueError) as e:
+        print >>sys.stderr, e
+        return 1
     fuzz = Fuzzer(anon_fields)
 
-    with open(CONF.filename, 'r') as r:
-        output_filename = CONF.filename + ".output"
-        with open(output_filename, 'w') as w:
-            for line in r:
-                processed = fuzz.process_line(line)
-                if CONF.debug:
-                    print '>>> %s' % line.rstrip()
-                    print '<<< %s' % processed.rstrip()
-                w.write(processed)
-            print "Wrote '%s'" % output_filename
+    output_filename = CONF.output
+    if CONF.format != 'sql':
+        if not output_filename and CONF.filename != fileio.STDIO:
+            output_filename = CONF.filename + "." + CONF.format
+        if output_filename in (None, fileio.STDIO):
+            print >>sys.stderr, 'Please specify an --output directory'
+            return 1
+    elif not output_filename:
+        if CONF.filename == fileio.STDIO:
+            output_filename = fileio.STDIO
+        else:
+            output_filename = CONF.filename + ".output"
+
+    try:
+        with fileio.open_input(CONF.filename) as r:
+            with output.open_output(output_filename, CONF.format,
+                                    CONF.chunk_rows, CONF.rows_per_insert,
+                                    CONF.max_statement_bytes) as w:
+                _anonymise(fuzz, r, w)
+    except ValueError as e:
+        print >>sys.stderr, 'Error: %s' % e
+        return 1
+    print >>sys.stderr, "Wrote '%s'" % output_filename
 
     if CONF.debug:
         fuzz.dump_stats(CONF.filename)
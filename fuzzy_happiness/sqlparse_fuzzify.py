@@ -14,14 +14,22 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import re
+import fileio
 import os
+import output
+import parallel
+import plans
+import randomise
+import resource
+import shutil
 import sqlparse
 import sys
+import tempfile
 
 from oslo.config import cfg
 
 import attributes
+import index
 
 
 CONF = cfg.CONF
@@ -34,78 +42,346 @@ opts = [
 ]
 CONF.register_opts(opts)
 
+cli_opts = [
+    output.output_opt,
+    parallel.workers_opt,
+    randomise.secret_opt,
+]
+CONF.register_cli_opts(cli_opts)
+CONF.register_cli_opt(index.index_opt)
+
+
+# How much of a run of inserts to hand to a worker process at a time
+_SEGMENT_SIZE = 8 * 1024 * 1024
+
+
+class _Segment(object):
+    """Anonymised output which a worker left in a temporary file"""
+
+    def __init__(self, path):
+        self.path = path
+
+
+def _anonymise_segment(task):
+    """Anonymise a run of inserts in a worker process, writing them to a
+    temporary segment file rather than sending them back"""
+    plan, directory, inserts = task
+    fd, path = tempfile.mkstemp(dir=directory, prefix='segment')
+    with os.fdopen(fd, 'w') as f:
+        for insert, pos in inserts:
+            f.write(plan.rewrite(insert, pos))
+    return _Segment(path)
+
+
+def _rewrite_range(plan, f, start, end):
+    """Yield bytes start to end of f, with the inserts in them anonymised
+    by plan"""
+    f.seek(start)
+    while start < end:
+        line = f.readline()
+        if not line:
+            raise IOError('Unexpected end of file at offset %d' % start)
+        start += len(line)
+        m = index.INSERT_RE.match(line)
+        yield plan.rewrite(line, m.end()) if m else line
+
 
-TABLE_NAME_RE = re.compile('CREATE TABLE `(.+)`')
-COLUMN_RE = re.compile('  `(.+)` ([^ ,]+).*')
+def _anonymise_range(task):
+    """Anonymise a run of inserts in a worker process, reading them from the
+    dump itself rather than having them sent over"""
+    plan, directory, input_path, start, end = task
+    fd, path = tempfile.mkstemp(dir=directory, prefix='segment')
+    with os.fdopen(fd, 'w') as out:
+        with fileio.open_input(input_path) as f:
+            for data in _rewrite_range(plan, f, start, end):
+                out.write(data)
+    return _Segment(path)
+
+
+class _Range(object):
+    """Bytes of the dump to be copied to the output as they are"""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
 
 
 class DumpProcessor(object):
-    def __init__(self, input_path, output_path, anon_fields):
+    def __init__(self, input_path, output_path, anon_fields, workers=1,
+                 index_path=None):
         self.input_path = input_path
         self.output_path = output_path
         self.anon_fields = anon_fields
+        self.workers = workers
+        self.index_path = index_path
+        self.plans = {}
+        self.tables = {}
 
     def read_sql_dump(self):
-        """Read a SQL dump file and process it."""
+        """Read a SQL dump file and process it.
 
-        # Optimization -- read blocks, separating by blank lines. Each block
-        # is parsed as a group.
-        with open(self.input_path) as f:
-            with open(self.output_path, 'w') as self.out:
-                pre_insert = []
-                inserts = []
-                post_insert = []
-
-                l = f.readline()
-                while l:
-                    if not l.startswith('-- Table structure for'):
-                        if l.startswith('INSERT'):
-                            inserts.append(l)
-                        elif not inserts:
-                            pre_insert.append(l)
-                        else:
-                            post_insert.append(l)
+        Only a CREATE TABLE statement is held in memory, until it is
+        complete and the columns of its table are known. Every other line
+        is anonymised if need be and written out as soon as it is read, so
+        memory use doesn't grow with the size of a table. high_water
+        records the most of the dump held in memory at once.
+
+        With more than one worker, runs of inserts are anonymised by a pool
+        of processes instead, see write_segments(). With an index of the
+        dump, the dump is handled as byte ranges, see indexed_ranges().
+        """
+
+        self.high_water = 0
+        if self.index_path:
+            try:
+                self.index = index.load_index(self.index_path,
+                                              self.input_path)
+            except (IOError, ValueError) as e:
+                print >>sys.stderr, 'Error: %s' % e
+                sys.exit(1)
+
+        with fileio.open_input(self.input_path) as f:
+            with fileio.open_output(self.output_path) as self.out:
+                if self.index_path and not hasattr(f, 'seek'):
+                    print >>sys.stderr, ('Error: an index can only be used '
+                                         'with an uncompressed dump file')
+                    sys.exit(1)
+
+                if self.workers > 1:
+                    self.write_segments(f)
+                    return
+
+                if self.index_path:
+                    self.write_ranges(f)
+                    return
+
+                for table, data in self.scan(f):
+                    if table is None:
+                        self.out.write(data)
                     else:
-                        post_insert.append(l)
-                        self.parse_block(''.join(pre_insert), inserts,
-                                         ''.join(post_insert))
-                        pre_insert = []
-                        inserts = []
-                        post_insert = []
-
-                    l = f.readline()
-
-                if pre_insert or inserts or post_insert:
-                    self.parse_block(''.join(pre_insert), inserts,
-                                     ''.join(post_insert))
-
-    def parse_block(self, pre_insert, inserts, post_insert):
-        """Parse one of these blocks that we've extracted."""
-
-        # Special case empty tables
-        if not inserts:
-            self.out.write(pre_insert)
-            self.out.write(''.join(inserts))
-            self.out.write(post_insert)
-            return
-
-        self.out.write(pre_insert)
-        create_statement = self.extract_create(pre_insert)
-        if not create_statement and inserts:
-            print 'Error! How can we have inserts without a create?'
-            print 'PRE %s' % pre_insert
-            for insert in inserts:
-                print 'INS %s' % insert
-            print 'PST %s' % post_insert
+                        self.handle_insert(table[0], table[1], data)
+
+    def scan(self, f):
+        """Split the dump in f into its parts.
+
+        Yields (None, text) for text to be copied to the output as it is,
+        and ((table name, columns), insert) for each insert statement. An
+        insert belongs to the last CREATE TABLE of its table before it,
+        whatever comes in between, so dumps made with --compact, which
+        have no comments between tables, work too. The inserts of tables
+        with nothing to anonymise count as text.
+        """
+
+        create = []
+        create_size = 0
+
+        for l in iter(f.readline, ''):
+            self.high_water = max(self.high_water, create_size + len(l))
+            if create:
+                create.append(l)
+                create_size += len(l)
+                if l.startswith(')'):
+                    create = ''.join(create)
+                    self.define_table(create)
+                    yield None, create
+                    create = []
+                    create_size = 0
+            elif l.startswith('CREATE TABLE'):
+                create.append(l)
+                create_size += len(l)
+            elif l.startswith('INSERT'):
+                m = index.INSERT_RE.match(l)
+                if not m:
+                    print >>sys.stderr, ('Error: Unable to parse insert %s'
+                                         % l)
+                    sys.exit(1)
+
+                table = self.table_for(m.group(1))
+                if not self.plan_for(table[0], table[1]).columns:
+                    # Nothing to anonymise, so copy this insert and the
+                    # ones which follow it without parsing them
+                    yield None, l
+                    for chunk in fileio.read_while(f, l[:m.end()]):
+                        self.high_water = max(self.high_water, len(chunk))
+                        yield None, chunk
+                    continue
+                yield table, l
+            else:
+                yield None, l
+
+        yield None, ''.join(create)
+
+    def define_table(self, create):
+        """Record the columns of the table a CREATE TABLE statement
+        creates, for the inserts into it which follow."""
+
+        table_name, columns = self.parse_create(self.extract_create(create))
+        if table_name is not None:
+            self.tables[table_name] = columns
+
+    def table_for(self, table_name):
+        """Return the name and columns of the table an insert is into.
+        Tables with something to anonymise must have been created first,
+        but others can be copied without knowing their columns."""
+
+        columns = self.tables.get(table_name)
+        if columns is None:
+            if self.anon_fields.get(table_name):
+                print >>sys.stderr, ('Error: the dump has inserts into %s '
+                                     'but no CREATE TABLE for it'
+                                     % table_name)
+                sys.exit(1)
+            columns = []
+        return table_name, columns
+
+    def write_segments(self, f):
+        """Anonymise the dump in f with a pool of worker processes.
+
+        Runs of inserts of up to _SEGMENT_SIZE bytes are handed to the
+        workers, so even a single huge table is spread across them. Each
+        worker writes its run to a temporary segment file, and the segments
+        are appended to the output in their original order, so the output
+        is the same as with a single process.
+        """
+
+        if self.output_path == fileio.STDIO:
+            directory = None
+        else:
+            # Keep the segments on the same filesystem as the output
+            directory = os.path.dirname(os.path.abspath(self.output_path))
+        directory = tempfile.mkdtemp(dir=directory, prefix='.fhsqlparse')
+        if self.index_path:
+            self.dump = f
+            tasks = self.range_tasks(directory)
+        else:
+            tasks = self.segment_tasks(f, directory)
+        try:
+            parallel.ordered_pipeline(tasks, self.write_result, self.workers,
+                                      depth=self.workers * 2)
+        except ValueError as e:
+            print >>sys.stderr, 'Error: %s' % e
             sys.exit(1)
+        finally:
+            shutil.rmtree(directory)
+
+    def segment_tasks(self, f, directory):
+        """The tasks for parallel.ordered_pipeline() which anonymise f"""
+
+        plan = None
+        inserts = []
+        size = 0
+        for table, data in self.scan(f):
+            if table is not None:
+                m = index.INSERT_RE.match(data)
+                if not m:
+                    print >>sys.stderr, ('Error: Unable to parse insert %s'
+                                         % data)
+                    sys.exit(1)
+                table_plan = self.plan_for(table[0], table[1])
+                if table_plan is not plan or size >= _SEGMENT_SIZE:
+                    if inserts:
+                        yield _anonymise_segment, (plan, directory, inserts)
+                    plan = table_plan
+                    inserts = []
+                    size = 0
+                inserts.append((data, m.end()))
+                size += len(data)
+                self.high_water = max(self.high_water, size)
+                continue
+
+            # Text can go straight to the output once the inserts before it
+            # are done
+            if inserts:
+                yield _anonymise_segment, (plan, directory, inserts)
+                plan = None
+                inserts = []
+                size = 0
+            yield None, data
 
-        if create_statement:
-            table_name, columns = self.parse_create(create_statement)
+        if inserts:
+            yield _anonymise_segment, (plan, directory, inserts)
 
-        for insert in inserts:
-            self.handle_insert(table_name, columns, insert)
+    def indexed_ranges(self):
+        """Split the dump into byte ranges using its index.
 
-        self.out.write(post_insert)
+        Yields (None, start, end) for ranges to be copied as they are, and
+        (plan, start, end) for runs of up to _SEGMENT_SIZE bytes of inserts
+        into a table to be anonymised with plan. Nothing but the index is
+        looked at, so tables with nothing to anonymise are never read
+        except to copy them.
+        """
+
+        table_plans = []
+        for table in self.index['tables']:
+            columns = table['columns']
+            if columns is None:
+                if self.anon_fields.get(table['name']):
+                    print >>sys.stderr, ('Error: the dump has inserts into '
+                                         '%s but no CREATE TABLE for it'
+                                         % table['name'])
+                    sys.exit(1)
+                columns = []
+            table_plans.append(self.plan_for(table['name'],
+                                             [tuple(column)
+                                              for column in columns]))
+
+        pos = start = 0
+        plan = None
+        for number, offset, length, rows in self.index['inserts']:
+            table_plan = table_plans[number]
+            if plan is not None and (table_plan is not plan or
+                                     offset + length - start > _SEGMENT_SIZE):
+                yield plan, start, pos
+                plan = None
+            if not table_plan.columns:
+                # Copied along with the text around it
+                continue
+            if plan is None:
+                if pos < offset:
+                    yield None, pos, offset
+                plan = table_plan
+                start = offset
+            pos = offset + length
+
+        if plan is not None:
+            yield plan, start, pos
+        if pos < self.index['size']:
+            yield None, pos, self.index['size']
+
+    def write_ranges(self, f):
+        """Anonymise the dump in f a range at a time, using its index"""
+
+        for plan, start, end in self.indexed_ranges():
+            if plan is None:
+                fileio.copy_range(f, self.out, start, end)
+                continue
+            try:
+                for data in _rewrite_range(plan, f, start, end):
+                    self.high_water = max(self.high_water, len(data))
+                    self.out.write(data)
+            except ValueError as e:
+                print >>sys.stderr, 'Error: %s' % e
+                sys.exit(1)
+
+    def range_tasks(self, directory):
+        """The tasks for parallel.ordered_pipeline() which anonymise the
+        dump using its index. The workers read the inserts themselves."""
+
+        for plan, start, end in self.indexed_ranges():
+            if plan is None:
+                yield None, _Range(start, end)
+            else:
+                yield _anonymise_range, (plan, directory, self.input_path,
+                                         start, end)
+
+    def write_result(self, result):
+        if isinstance(result, _Segment):
+            fileio.append_file(self.out, result.path)
+            os.unlink(result.path)
+        elif isinstance(result, _Range):
+            fileio.copy_range(self.dump, self.out, result.start, result.end)
+        else:
+            self.out.write(result)
 
     def extract_create(self, pre_insert):
         """Extract the create statement from a block of SQL."""
@@ -158,11 +434,12 @@ class DumpProcessor(object):
                         create_statement = True
                         continue
 
-                print 'Unknown parser token!'
-                print token
-                print dir(token)
-                print 'ttype: %s = >>%s<<' % (str(token.ttype), token.value)
-                print '    %s: %s' % (type(token), repr(token))
+                print >>sys.stderr, 'Unknown parser token!'
+                print >>sys.stderr, token
+                print >>sys.stderr, dir(token)
+                print >>sys.stderr, ('ttype: %s = >>%s<<'
+                                     % (str(token.ttype), token.value))
+                print >>sys.stderr, '    %s: %s' % (type(token), repr(token))
 
         return ' '.join(create_data)
 
@@ -180,56 +457,53 @@ class DumpProcessor(object):
         columns = []
 
         for line in create_statement.split('\n'):
-            m = TABLE_NAME_RE.match(line)
+            m = index.TABLE_NAME_RE.match(line)
             if m:
                 table_name = m.group(1)
 
-            m = COLUMN_RE.match(line)
+            m = index.COLUMN_RE.match(line)
             if m:
                 columns.append((m.group(1), m.group(2)))
 
         return table_name, columns
 
     def handle_insert(self, table_name, columns, insert):
-        """Parse an insert statement into its rows."""
+        """Anonymise an insert statement and write it out.
 
-        for parse in sqlparse.parse(insert):
-            for token in parse.tokens:
-                if not isinstance(token, sqlparse.sql.Parenthesis):
-                    continue
-
-                row = []
-                for subtoken in token.tokens:
-                    if not isinstance(subtoken, sqlparse.sql.IdentifierList):
-                        continue
-
-                    for ident in subtoken.tokens:
-                        if str(ident.ttype) == 'Token.Punctuation':
-                            continue
-                        row.append(ident.value)
-
-                if row:
-                    self.anonymize_row(table_name, columns, row)
+        sqlparse is far too slow for the bulk of a dump, so the rows are
+        found by the lexer in CSVParser instead, and only the fields which
+        need anonymising are replaced.
+        """
 
-    def anonymize_row(self, table_name, columns, row):
-        """Handle a single row."""
+        m = index.INSERT_RE.match(insert)
+        if not m:
+            print >>sys.stderr, 'Error: Unable to parse insert %s' % insert
+            sys.exit(1)
 
-        if len(columns) != len(row):
-            print 'Error: How did we end up with the wrong number of columns?'
+        plan = self.plan_for(table_name, columns)
+        try:
+            self.out.write(plan.rewrite(insert, m.end()))
+        except ValueError as e:
+            print >>sys.stderr, 'Error: %s' % e
             sys.exit(1)
 
-        print table_name
-        counter = 0
-        for column in row:
-            print '    %s %s = %s' % (columns[counter][0],
-                                      columns[counter][1],
-                                      column)
-            counter += 1
+    def plan_for(self, table_name, columns):
+        """Return the anonymisation plan for a table, compiling it once for
+        all the inserts of a table"""
+
+        key = (table_name, tuple(columns))
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = plans.compile_plan(table_name, columns,
+                                      self.anon_fields.get(table_name),
+                                      debug=CONF.debug)
+            self.plans[key] = plan
+        return plan
 
 
 filename_opt = cfg.StrOpt('filename',
                           default=None,
-                          help='The filename to process',
+                          help='The filename to process, or - for stdin',
                           positional=True)
 
 
@@ -238,23 +512,39 @@ def main():
     CONF(sys.argv[1:], project='fuzzy-happiness')
 
     if not CONF.filename:
-        print 'Please specify a filename to process'
+        print >>sys.stderr, 'Please specify a filename to process'
         return 1
 
-    print 'Processing %s' % CONF.filename
-    if not os.path.exists(CONF.filename):
-        print 'Input file %s does not exist!' % CONF.filename
-        return 1
-    if not os.path.isfile(CONF.filename):
-        print 'Input %s is not a file!' % CONF.filename
+    print >>sys.stderr, 'Processing %s' % CONF.filename
+    error = fileio.check_input(CONF.filename)
+    if error:
+        print >>sys.stderr, error
         return 1
 
-    # Load attributes from models.py
-    anon_fields = attributes.load_configuration()
+    output_filename = CONF.output
+    if not output_filename:
+        if CONF.filename == fileio.STDIO:
+            output_filename = fileio.STDIO
+        else:
+            output_filename = CONF.filename + '.post'
+
+    if CONF.secret:
+        randomise.set_secret(CONF.secret)
+
+    # Load attributes from models.py, or a policy file
+    try:
+        anon_fields = attributes.get_configuration()
+    except (ImportError, IOError, ValueError) as e:
+        print >>sys.stderr, e
+        return 1
 
-    dp = DumpProcessor(CONF.filename,
-                       '/tmp/nova_user_001.sql.post',
-                       anon_fields)
+    dp = DumpProcessor(CONF.filename, output_filename, anon_fields,
+                       CONF.workers, CONF.index)
     dp.read_sql_dump()
+    print >>sys.stderr, ('At most %d bytes of the dump were held in memory, '
+                         'maximum resident set size %d kB'
+                         % (dp.high_water,
+                            resource.getrusage(
+                                resource.RUSAGE_SELF).ru_maxrss))
 
     return 0
@@ -47,3 +47,88 @@ class TestParse(testtools.TestCase):
         csv = CSVParser.CSVParser()
         self.assertEqual(csv.parse(input), output)
         self.assertEqual(', '.join(output), input)
+
+    def test_null(self):
+        input = "1,NULL,'NULL',NULL"
+        output = ['1', 'NULL', "'NULL'", 'NULL']
+        csv = CSVParser.CSVParser()
+        self.assertEqual(csv.parse(input), output)
+        self.assertEqual(','.join(output), input)
+
+    def test_backslash_escapes(self):
+        input = r"'it\'s','a\\',b,'x\,y'"
+        output = [r"'it\'s'", r"'a\\'", 'b', r"'x\,y'"]
+        csv = CSVParser.CSVParser()
+        self.assertEqual(csv.parse(input), output)
+        self.assertEqual(','.join(output), input)
+
+    def test_doubled_quotes(self):
+        input = "'it''s, really',\"say \"\"hi\"\"\",''"
+        output = ["'it''s, really'", "\"say \"\"hi\"\"\"", "''"]
+        csv = CSVParser.CSVParser()
+        self.assertEqual(csv.parse(input), output)
+        self.assertEqual(','.join(output), input)
+
+    def test_unquote(self):
+        self.assertEqual("it's \"x\"", CSVParser.unquote("'it''s \"x\"'"))
+        self.assertEqual("ab'c \"\"", CSVParser.unquote('"ab\'c """"\"'))
+
+    def test_binary_and_hex(self):
+        input = "_binary 'a\\0,b',0x6869,_binary '',-1.5e+10"
+        output = ["_binary 'a\\0,b'", '0x6869', "_binary ''", '-1.5e+10']
+        csv = CSVParser.CSVParser()
+        self.assertEqual(csv.parse(input), output)
+        self.assertEqual(','.join(output), input)
+
+    def test_reuse(self):
+        csv = CSVParser.CSVParser()
+        self.assertEqual(csv.parse("1,'a'"), ['1', "'a'"])
+        self.assertEqual(csv.parse("2,'b'"), ['2', "'b'"])
+
+    def test_unterminated_quote(self):
+        csv = CSVParser.CSVParser()
+        self.assertRaises(ValueError, csv.parse, "1,'abc")
+
+
+class TestRowSpans(testtools.TestCase):
+
+    def fields(self, values, pos=0):
+        csv = CSVParser.CSVParser()
+        return [[values[start:end] for start, end in spans]
+                for spans in csv.row_spans(values, pos)]
+
+    def test_rows(self):
+        values = "(1,'a'),(2,NULL);\n"
+        self.assertEqual(self.fields(values),
+                         [['1', "'a'"], ['2', 'NULL']])
+
+    def test_brackets_in_quotes(self):
+        values = "(1,'x),(y'),(2,'(\\')')"
+        self.assertEqual(self.fields(values),
+                         [['1', "'x),(y'"], ['2', "'(\\')'"]])
+
+    def test_offset(self):
+        line = "INSERT INTO `t` VALUES (_binary 'a',0x00);"
+        self.assertEqual(self.fields(line, line.index('(')),
+                         [["_binary 'a'", '0x00']])
+
+    def test_garbage(self):
+        self.assertRaises(ValueError, self.fields, "(1,2) (3,4)")
+
+    def test_complete_rows(self):
+        csv = CSVParser.CSVParser()
+        values = "(1,'a'),(2,'b),(c'),(3,'d"
+        rows, end, finished = csv.complete_rows(values)
+        self.assertEqual([[(1, 2), (3, 6)], [(9, 10), (11, 18)]], rows)
+        self.assertEqual("(3,'d", values[end:])
+        self.assertFalse(finished)
+
+        values = "(1,'a'),(2,'b');\n"
+        rows, end, finished = csv.complete_rows(values)
+        self.assertEqual(2, len(rows))
+        self.assertEqual(';\n', values[end:])
+        self.assertTrue(finished)
+
+        # The delimiter after a row has to be seen for it to be complete
+        self.assertEqual(([], 0, False), csv.complete_rows("(1,'a')"))
+        self.assertRaises(ValueError, csv.complete_rows, "(1,2) (3,4)")
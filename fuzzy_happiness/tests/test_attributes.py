@@ -0,0 +1,78 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import testtools
+
+from fuzzy_happiness import attributes
+
+
+_CONFIG = {'instances': {'hostname': 'hostname'}}
+
+
+class TestCachedConfiguration(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCachedConfiguration, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache = os.path.join(self.tmpdir, 'attributes.json')
+        attributes.CONF.set_override('config_cache', self.cache)
+        self.addCleanup(attributes.CONF.clear_override, 'config_cache')
+
+        self.models = os.path.join(self.tmpdir, 'models.py')
+        with open(self.models, 'w') as f:
+            f.write('# models\n')
+
+    def write_cache(self, stamp):
+        with open(self.cache, 'w') as f:
+            json.dump({'models': stamp, 'config': _CONFIG}, f)
+
+    def test_fresh_cache(self):
+        self.patch(attributes, 'find_models', lambda: self.models)
+        self.write_cache(attributes._stamp(self.models))
+        self.assertEqual(_CONFIG, attributes.load_cached_configuration())
+
+    def test_no_nova(self):
+        self.patch(attributes, 'find_models', lambda: None)
+        self.assertRaises(ImportError, attributes.load_cached_configuration)
+        self.write_cache(['/elsewhere/models.py', 0, 0])
+        self.assertEqual(_CONFIG, attributes.load_cached_configuration())
+
+    def test_stale_cache_exported(self):
+        self.patch(attributes, 'find_models', lambda: self.models)
+        self.write_cache(['/elsewhere/models.py', 0, 0])
+        commands = []
+
+        def export(command, **kwargs):
+            commands.append(command)
+            self.write_cache(attributes._stamp(self.models))
+
+        self.patch(attributes.subprocess, 'check_call', export)
+        self.assertEqual(_CONFIG, attributes.load_cached_configuration())
+        self.assertEqual(1, len(commands))
+        self.assertIn('--export', commands[0])
+
+    def test_export_fails(self):
+        self.patch(attributes, 'find_models', lambda: self.models)
+
+        def export(command, **kwargs):
+            raise attributes.subprocess.CalledProcessError(1, command)
+
+        self.patch(attributes.subprocess, 'check_call', export)
+        e = self.assertRaises(IOError, attributes.load_cached_configuration)
+        self.assertIn('exit status 1', str(e))
@@ -0,0 +1,109 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import testtools
+
+from fuzzy_happiness import fileio
+
+
+_DUMP = ''.join("INSERT INTO `t` VALUES (%d,'row %d');\n" % (i, i)
+                for i in range(50000))
+
+
+class TestCompression(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCompression, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def roundtrip(self, name):
+        path = os.path.join(self.tmpdir, name)
+        with fileio.open_output(path) as w:
+            w.write(_DUMP)
+
+        # Detection is by content, not by name
+        renamed = os.path.join(self.tmpdir, 'dump')
+        os.rename(path, renamed)
+        with fileio.open_input(renamed) as r:
+            lines = list(r)
+        self.assertEqual(50000, len(lines))
+        self.assertEqual(_DUMP, ''.join(lines))
+
+        with open(renamed, 'rb') as r:
+            return r.read()
+
+    def test_plain(self):
+        self.assertEqual(_DUMP, self.roundtrip('dump.sql'))
+
+    def test_gzip(self):
+        self.assertTrue(self.roundtrip('dump.sql.gz').startswith('\x1f\x8b'))
+
+    def test_bz2(self):
+        self.assertTrue(self.roundtrip('dump.sql.bz2').startswith('BZh'))
+
+    def test_concatenated_gzip(self):
+        path = os.path.join(self.tmpdir, 'dump.sql.gz')
+        with fileio.open_output(path) as w:
+            w.write(_DUMP)
+        with open(path, 'rb') as r:
+            compressed = r.read()
+        with open(path, 'wb') as w:
+            w.write(compressed * 2)
+        with fileio.open_input(path) as r:
+            self.assertEqual(_DUMP * 2, r.read())
+
+
+class TestReadWhile(testtools.TestCase):
+
+    def setUp(self):
+        super(TestReadWhile, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def check(self, name):
+        path = os.path.join(self.tmpdir, name)
+        with fileio.open_output(path) as w:
+            w.write(_DUMP + 'UNLOCK TABLES;\nINSERT INTO `t` VALUES (1);\n')
+        with fileio.open_input(path) as r:
+            first = r.readline()
+            copied = ''.join(fileio.read_while(r, first[:len('INSERT')]))
+            self.assertEqual(_DUMP, first + copied)
+            self.assertEqual('UNLOCK TABLES;\n', r.readline())
+            self.assertEqual([], list(fileio.read_while(r, 'UNLOCK')))
+            self.assertEqual('INSERT INTO `t` VALUES (1);\n',
+                             ''.join(fileio.read_while(r, 'INSERT')))
+            self.assertEqual('', r.read())
+
+    def test_plain(self):
+        self.check('dump.sql')
+
+    def test_gzip(self):
+        self.check('dump.sql.gz')
+
+    def test_mapped(self):
+        self.check('dump.sql')
+        path = os.path.join(self.tmpdir, 'dump.sql')
+        with fileio.open_input(path) as r:
+            self.assertIsInstance(r, fileio.MappedReader)
+
+    def test_empty(self):
+        path = os.path.join(self.tmpdir, 'empty.sql')
+        open(path, 'w').close()
+        with fileio.open_input(path) as r:
+            self.assertEqual('', r.readline())
+            self.assertEqual([], list(fileio.read_while(r, 'INSERT')))
@@ -0,0 +1,136 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import testtools
+
+from sqlalchemy import Column, ForeignKeyConstraint, Integer, MetaData
+from sqlalchemy import String, Table
+
+from fuzzy_happiness import fkplan
+
+
+class TestFKPlan(testtools.TestCase):
+
+    def setUp(self):
+        super(TestFKPlan, self).setUp()
+        self.metadata = MetaData()
+        self.instances = Table(
+            'instances', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('uuid', String(36), unique=True),
+            Column('hostname', String(255)))
+        self.faults = Table(
+            'faults', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('instance_uuid', String(36)),
+            Column('message', String(255)),
+            ForeignKeyConstraint(['instance_uuid'], ['instances.uuid'],
+                                 name='faults_fk'))
+        self.actions = Table(
+            'actions', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('instance_uuid', String(36)),
+            ForeignKeyConstraint(['instance_uuid'], ['instances.uuid'],
+                                 name='actions_fk', onupdate='CASCADE'))
+        self.metrics = Table(
+            'metrics', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('instance_id', Integer),
+            ForeignKeyConstraint(['instance_id'], ['instances.id'],
+                                 name='metrics_fk'))
+
+    def plan(self, config):
+        return fkplan.FKPlan(self.metadata,
+                             [(self.metadata.tables[name], columns)
+                              for name, columns in config])
+
+    def test_only_confidential_references(self):
+        plan = self.plan([('instances', {'uuid': 'uuid'}),
+                          ('faults', {'message': 'varchar'}),
+                          ('metrics', {})])
+        self.assertEqual(['faults_fk'], [c.name for c in plan.rewrite])
+        self.assertEqual(['actions_fk'], [c.name for c in plan.cascading])
+        self.assertEqual(set([('faults', 'instance_uuid'),
+                              ('actions', 'instance_uuid')]),
+                         plan.cascaded)
+
+    def test_nothing_confidential_referenced(self):
+        plan = self.plan([('instances', {'hostname': 'hostname'})])
+        self.assertEqual([], plan.rewrite)
+        self.assertEqual(set(), plan.cascaded)
+
+    def test_columns_for(self):
+        plan = self.plan([('instances', {'uuid': 'uuid'})])
+        self.assertEqual({'message': 'varchar'},
+                         plan.columns_for(self.faults,
+                                          {'instance_uuid': 'uuid',
+                                           'message': 'varchar'}))
+
+    def test_levels(self):
+        plan = self.plan([('faults', {}), ('metrics', {}),
+                          ('instances', {'uuid': 'uuid'})])
+        self.assertEqual([['instances'], ['faults', 'metrics']],
+                         [[t.name for t in level] for level in plan.levels])
+
+    def test_describe(self):
+        plan = self.plan([('instances', {'uuid': 'uuid'})])
+        self.assertIn('faults_fk: faults(instance_uuid) -> instances(uuid)',
+                      plan.describe())
+
+    def test_keyed(self):
+        plan = fkplan.FKPlan(self.metadata,
+                             [(self.instances, {'uuid': 'uuid'}),
+                              (self.faults, {'message': 'varchar'})],
+                             keyed=True)
+        self.assertEqual([('actions', {'instance_uuid': 'uuid'}),
+                          ('faults', {'instance_uuid': 'uuid',
+                                      'message': 'varchar'}),
+                          ('instances', {'uuid': 'uuid'})],
+                         [(t.name, columns) for t, columns in plan.tables])
+        self.assertEqual([['instances'], ['actions', 'faults']],
+                         [[t.name for t in level] for level in plan.levels])
+
+    def test_keyed_chain(self):
+        Table('notes', self.metadata,
+              Column('id', Integer, primary_key=True),
+              Column('fault_uuid', String(36)),
+              ForeignKeyConstraint(['fault_uuid'], ['faults.instance_uuid'],
+                                   name='notes_fk'))
+        plan = fkplan.FKPlan(self.metadata,
+                             [(self.instances, {'uuid': 'uuid'})],
+                             keyed=True)
+        self.assertIn(('notes', {'fault_uuid': 'uuid'}),
+                      [(t.name, columns) for t, columns in plan.tables])
+
+    def test_keyed_type_mismatch(self):
+        self.assertRaises(ValueError, fkplan.FKPlan, self.metadata,
+                          [(self.instances, {'uuid': 'uuid'}),
+                           (self.faults, {'instance_uuid': 'varchar'})],
+                          keyed=True)
+
+    def test_keyed_primary_key_referenced(self):
+        plan = fkplan.FKPlan(self.metadata,
+                             [(self.instances, {'id': 'int'})],
+                             keyed=True)
+        self.assertEqual([('instances', {'id': 'int'})],
+                         [(t.name, columns) for t, columns in plan.tables])
+        self.assertRaises(ValueError, fkplan.FKPlan, self.metadata,
+                          [(self.instances, {'id': 'int'}),
+                           (self.metrics, {'instance_id': 'int'})],
+                          keyed=True)
+
+    def test_unkeyed_tables(self):
+        tables = [(self.instances, {'uuid': 'uuid'})]
+        self.assertEqual(tables, self.plan([('instances',
+                                             {'uuid': 'uuid'})]).tables)
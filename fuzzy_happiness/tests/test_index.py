@@ -0,0 +1,67 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import StringIO
+import tempfile
+import testtools
+
+from fuzzy_happiness import index
+from fuzzy_happiness.tests import test_sqlparse_fuzzify
+
+
+_DUMP = test_sqlparse_fuzzify._DUMP
+
+
+class TestIndex(testtools.TestCase):
+
+    def test_build(self):
+        idx = index.build_index(StringIO.StringIO(_DUMP))
+        self.assertEqual(len(_DUMP), idx['size'])
+        self.assertEqual(['instances', 'services'],
+                         [table['name'] for table in idx['tables']])
+        self.assertEqual([['id', 'int(11)'], ['hostname', 'varchar(255)'],
+                          ['notes', 'text']], idx['tables'][0]['columns'])
+        self.assertEqual([0, 0, 1], [i[0] for i in idx['inserts']])
+        self.assertEqual([2, 1, 2], [i[3] for i in idx['inserts']])
+        for table in idx['tables']:
+            self.assertTrue(_DUMP[table['offset']:].startswith(
+                'CREATE TABLE `%s`' % table['name']))
+        for number, offset, length, rows in idx['inserts']:
+            self.assertEqual('INSERT', _DUMP[offset:offset + 6])
+            self.assertEqual(';\n', _DUMP[offset + length - 2:offset + length])
+
+    def test_no_create(self):
+        idx = index.build_index(StringIO.StringIO(
+            "INSERT INTO `t` VALUES (1);\n"))
+        self.assertEqual([{'name': 't', 'columns': None, 'offset': None}],
+                         idx['tables'])
+
+    def test_out_of_date(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        dump_path = os.path.join(tmpdir, 'dump.sql')
+        index_path = dump_path + '.fhindex'
+        with open(dump_path, 'w') as f:
+            f.write(_DUMP)
+        with open(dump_path) as f:
+            index.write_index(index_path, dump_path, index.build_index(f))
+        self.assertEqual(len(_DUMP),
+                         index.load_index(index_path, dump_path)['size'])
+
+        with open(dump_path, 'a') as f:
+            f.write('\n')
+        self.assertRaises(ValueError, index.load_index, index_path,
+                          dump_path)
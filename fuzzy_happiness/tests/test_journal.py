@@ -0,0 +1,66 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import testtools
+
+from fuzzy_happiness import journal
+
+
+class TestJournal(testtools.TestCase):
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'journal')
+
+    def test_resume(self):
+        j = journal.Journal(self.path)
+        parts = j.ranges('instances', lambda: [(None, 100), (100, None)])
+        self.assertEqual([[None, 100], [100, None]],
+                         [part['range'] for part in parts])
+        j.checkpoint('instances', 0, last_pk=[42], rows=42)
+        j.checkpoint('instances', 1, pushed=True, done=True)
+        j.fkeys_changing({'fk_instances': None})
+
+        resumed = journal.Journal.load(self.path)
+        parts = resumed.ranges('instances', lambda: [(None, None)])
+        self.assertEqual([[None, 100], [100, None]],
+                         [part['range'] for part in parts])
+        self.assertEqual(([42], 42, False), (parts[0]['last_pk'],
+                                             parts[0]['rows'],
+                                             parts[0]['done']))
+        self.assertTrue(parts[1]['done'])
+        self.assertEqual({'fk_instances': None}, resumed.pending_fkeys())
+
+        resumed.fkeys_restored()
+        self.assertEqual({}, journal.Journal.load(self.path).pending_fkeys())
+
+    def test_no_temporary_files_left(self):
+        j = journal.Journal(self.path)
+        j.ranges('instances', lambda: [(None, None)])
+        j.checkpoint('instances', 0, done=True)
+        self.assertEqual(['journal'], os.listdir(self.tmpdir))
+        j.finish()
+        self.assertEqual([], os.listdir(self.tmpdir))
+
+    def test_in_memory(self):
+        j = journal.Journal(None)
+        j.ranges('instances', lambda: [(None, None)])
+        j.checkpoint('instances', 0, done=True)
+        j.finish()
+        self.assertEqual([], os.listdir(self.tmpdir))
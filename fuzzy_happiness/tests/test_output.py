@@ -0,0 +1,84 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import testtools
+
+from fuzzy_happiness import output
+
+
+_CREATE = ['CREATE TABLE `t` (\n', '  `id` int(11),\n',
+           ') ENGINE=InnoDB;\n']
+
+
+class TestOutput(testtools.TestCase):
+
+    def setUp(self):
+        super(TestOutput, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def read(self, name):
+        with open(os.path.join(self.tmpdir, name)) as f:
+            return f.read()
+
+    def test_tsv(self):
+        with output.open_output(self.tmpdir, 'tsv') as w:
+            for line in ['-- A dump\n'] + _CREATE:
+                w.write(line)
+            w.write(output.Rows('t', '1\n2\n'))
+            w.write(output.Rows('u', '3\n'))
+            w.write(output.Rows('t', '4\n'))
+        self.assertEqual(['load.sql', 'schema.sql', 't.tsv', 'u.tsv'],
+                         sorted(os.listdir(self.tmpdir)))
+        self.assertEqual('-- A dump\n' + ''.join(_CREATE),
+                         self.read('schema.sql'))
+        self.assertEqual('1\n2\n4\n', self.read('t.tsv'))
+        self.assertIn("LOAD DATA LOCAL INFILE 'u.tsv' INTO TABLE `u`",
+                      self.read('load.sql'))
+
+    def test_mydumper(self):
+        with output.open_output(self.tmpdir, 'mydumper', 3) as w:
+            w.write('-- Host: localhost    Database: nova_cells\n')
+            for line in _CREATE:
+                w.write(line)
+            w.write('LOCK TABLES `t` WRITE;\n')
+            for i in range(4):
+                w.write(output.Rows('t', 'INSERT %d;\n' % i, 2))
+        self.assertEqual(['metadata', 'nova_cells-schema-create.sql',
+                          'nova_cells.t-schema.sql', 'nova_cells.t.00000.sql',
+                          'nova_cells.t.00001.sql'],
+                         sorted(os.listdir(self.tmpdir)))
+        self.assertTrue(self.read('nova_cells.t-schema.sql').endswith(
+            ''.join(_CREATE)))
+        self.assertTrue(self.read('nova_cells.t.00000.sql').endswith(
+            'INSERT 0;\nINSERT 1;\n'))
+        self.assertIn('Finished dump at', self.read('metadata'))
+
+    def test_rebatch(self):
+        path = os.path.join(self.tmpdir, 'dump.sql')
+        prefix = 'INSERT INTO `t` VALUES '
+        with output.open_output(path, rows_per_insert=3,
+                                max_statement_bytes=len(prefix) + 12) as w:
+            w.write(output.Values('t', prefix, ['(1)', '(2)']))
+            w.write(output.Values('t', prefix, ['(3)', '(4)', '(55555555)']))
+            w.write(output.Values('u', prefix, ['(6)']))
+            w.write('UNLOCK TABLES;\n')
+        self.assertEqual(prefix + '(1),(2),(3);\n' +
+                         prefix + '(4);\n' +
+                         prefix + '(55555555);\n' +
+                         prefix + '(6);\n' +
+                         'UNLOCK TABLES;\n', self.read('dump.sql'))
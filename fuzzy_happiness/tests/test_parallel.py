@@ -0,0 +1,75 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+
+import testtools
+
+from fuzzy_happiness import parallel
+
+
+def _slow_square(n):
+    # Early tasks finish last, so results arrive out of order
+    time.sleep((20 - n) * 0.002)
+    return n * n
+
+
+def _fail_on_seven(n):
+    if n == 7:
+        raise ValueError('seven')
+    return n
+
+
+class TestOrderedPipeline(testtools.TestCase):
+
+    def test_order(self):
+        results = []
+        tasks = []
+        for n in range(20):
+            if n % 3:
+                tasks.append((_slow_square, n))
+            else:
+                tasks.append((None, 'text %d' % n))
+        parallel.ordered_pipeline(tasks, results.append, 4, depth=6)
+        self.assertEqual([n * n if n % 3 else 'text %d' % n
+                          for n in range(20)], results)
+
+    def test_task_failure(self):
+        results = []
+        tasks = [(_fail_on_seven, n) for n in range(20)]
+        e = self.assertRaises(ValueError, parallel.ordered_pipeline, tasks,
+                              results.append, 3)
+        self.assertEqual('seven', str(e))
+        self.assertEqual(range(7), results)
+
+    def test_write_failure(self):
+        def write(result):
+            if result == 3:
+                raise IOError('disk full')
+
+        tasks = [(None, n) for n in range(100)]
+        self.assertRaises(IOError, parallel.ordered_pipeline, tasks, write,
+                          2)
+
+
+class TestThreadPool(testtools.TestCase):
+
+    def test_failure(self):
+        done = []
+
+        def fail():
+            raise ValueError('broken')
+
+        tasks = [lambda: done.append(1), fail]
+        self.assertRaises(ValueError, parallel.thread_pool, tasks, 1)
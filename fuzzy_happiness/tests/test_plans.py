@@ -0,0 +1,194 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import pickle
+import re
+import StringIO
+import sys
+import testtools
+
+from fuzzy_happiness import CSVParser
+from fuzzy_happiness import plans
+from fuzzy_happiness import randomise
+
+
+_COLUMNS = [('id', 'int(11)'), ('name', 'varchar(255)'), ('notes', 'text')]
+
+
+class TestTablePlan(testtools.TestCase):
+
+    def fields(self, line):
+        csv = CSVParser.CSVParser()
+        return [[line[start:end] for start, end in spans]
+                for spans in csv.row_spans(line, line.index('('))]
+
+    def test_null_plan(self):
+        plan = plans.compile_plan('t', _COLUMNS, None)
+        self.assertEqual((), plan.columns)
+        line = "INSERT INTO `t` VALUES (1,'a','b'),(2,'c','d');\n"
+        self.assertIs(line, plan.rewrite(line, line.index('(')))
+
+    def test_only_anonymised_columns_change(self):
+        plan = plans.compile_plan('t', _COLUMNS, {'name': 'varchar'})
+        line = "INSERT INTO `t` VALUES (1,'ab','x, y'),(2,NULL,'z');\n"
+        new = plan.rewrite(line, line.index('('))
+        rows = self.fields(new)
+        self.assertEqual(['1', 'x, y', 'z', '2', 'NULL'],
+                         [rows[0][0], CSVParser.unquote(rows[0][2]),
+                          CSVParser.unquote(rows[1][2]), rows[1][0],
+                          rows[1][1]])
+        self.assertEqual(4, len(rows[0][1]))
+        self.assertTrue(new.startswith('INSERT INTO `t` VALUES (1,'))
+        self.assertTrue(new.endswith(");\n"))
+
+    def test_escaping(self):
+        plan = plans.compile_plan('t', _COLUMNS, {'notes': 'varchar'})
+        line = "INSERT INTO `t` VALUES (1,'a','" + "\\'\\\\" * 50 + "');\n"
+        for i in range(20):
+            rows = self.fields(plan.rewrite(line, line.index('(')))
+            self.assertEqual(100, len(CSVParser.unquote(rows[0][2])))
+
+    def test_double_quotes(self):
+        plan = plans.compile_plan('t', _COLUMNS, {'name': 'varchar'})
+        line = 'INSERT INTO `t` VALUES (1,"ab\'c","x"),(2,"plain","y");\n'
+        for i in range(20):
+            rows = self.fields(plan.rewrite(line, line.index('(')))
+            self.assertEqual(['"x"', '"y"'], [row[2] for row in rows])
+            names = [CSVParser.unquote(row[1]) for row in rows]
+            self.assertEqual([4, 5], [len(name) for name in names])
+            self.assertEqual("'", rows[1][1][0])
+
+    def test_unquoted_numbers(self):
+        plan = plans.compile_plan('t', _COLUMNS, {'id': 'int'})
+        line = "INSERT INTO `t` VALUES (-12345,'a','b'),(3.8e07,'c','d'),"
+        line += "(0x65580,'e','f');\n"
+        for i in range(20):
+            rows = self.fields(plan.rewrite(line, line.index('(')))
+            ids = [row[0] for row in rows]
+            self.assertTrue(re.match(r'^-[0-9]{5}$', ids[0]))
+            self.assertTrue(re.match(r'^[0-9]\.[0-9]e07$', ids[1]))
+            self.assertTrue(re.match(r'^0x[0-9a-fA-F]{5}$', ids[2]))
+
+    def test_unquoted_other(self):
+        plan = plans.compile_plan('t', _COLUMNS, {'id': 'uuid'})
+        line = "INSERT INTO `t` VALUES (TRUE,'a','b'),(NULL,'c','d');\n"
+        rows = self.fields(plan.rewrite(line, line.index('(')))
+        self.assertTrue(rows[0][0].startswith("'fake"))
+        self.assertEqual('NULL', rows[1][0])
+
+    def test_not_anonymisable(self):
+        plan = plans.compile_plan('t', _COLUMNS, {'name': 'ip_address'})
+        line = "INSERT INTO `t` VALUES (1,'fe80::1','b');\n"
+        stderr = StringIO.StringIO()
+        self.patch(sys, 'stderr', stderr)
+        self.patch(plans, '_warned', set())
+        rows = self.fields(plan.rewrite(line, line.index('(')))
+        self.assertEqual('NULL', rows[0][1])
+        self.assertIn('`name`', stderr.getvalue())
+
+    def test_wrong_width(self):
+        plan = plans.compile_plan('t', _COLUMNS, {'name': 'varchar'})
+        line = "INSERT INTO `t` VALUES (1,'a');\n"
+        self.assertRaises(ValueError, plan.rewrite, line, line.index('('))
+
+    def test_values(self):
+        plan = plans.compile_plan('t', _COLUMNS, {'notes': 'varchar'})
+        line = "INSERT INTO `t` VALUES (1,'a','bc'),(2,NULL,NULL);\n"
+        values = plan.values(line, line.index('('))
+        self.assertEqual(2, len(values))
+        self.assertTrue(values[0].startswith("(1,'a','"))
+        self.assertEqual(len("(1,'a','bc')"), len(values[0]))
+        self.assertEqual('(2,NULL,NULL)', values[1])
+
+    def test_to_tsv(self):
+        plan = plans.compile_plan('t', _COLUMNS, {'name': 'varchar'})
+        line = ("INSERT INTO `t` VALUES (1,'ab','x\ty\\n'),"
+                "(2,NULL,_binary '\\0'),(3,'c',0x0a);\n")
+        rows = [row.split('\t')
+                for row in plan.to_tsv(line, line.index('(')).splitlines()]
+        self.assertEqual([['1', 'x\\ty\\n'], ['2', '\\0'],
+                          ['3', '\\n']], [[row[0], row[2]] for row in rows])
+        self.assertEqual(2, len(rows[0][1]))
+        self.assertEqual('\\N', rows[1][1])
+
+    def test_rewrite_stream(self):
+        # Keyed mode makes the output independent of how rows are batched
+        randomise.set_secret('sekrit')
+        self.addCleanup(randomise.set_secret, None)
+        plan = plans.compile_plan('t', _COLUMNS, {'name': 'varchar'})
+        line = ('INSERT INTO `t` VALUES ' +
+                ','.join("(%d,'name %d','x),(y\\'z')" % (i, i)
+                         for i in range(100)) + ';\n')
+        pos = line.index('(')
+        for max_buffer in (30, 100, 1000):
+            f = StringIO.StringIO(line)
+            start = f.readline(max_buffer)
+            pieces = list(plan.rewrite_stream(start, pos, f.readline,
+                                              max_buffer))
+            self.assertTrue(max(len(piece) for piece in pieces) <=
+                            max_buffer)
+            self.assertEqual(plan.rewrite(line, pos), ''.join(pieces))
+
+    def test_to_tsv_hex(self):
+        plan = plans.compile_plan('t', _COLUMNS, {'name': 'varchar'})
+        line = "INSERT INTO `t` VALUES (0x71,'ab',0x71);\n"
+        row = plan.to_tsv(line, line.index('(')).rstrip('\n').split('\t')
+        self.assertEqual(['113', 'q'], [row[0], row[2]])
+
+        # Anonymised hex literals are numbers in numeric columns too
+        plan = plans.compile_plan('t', _COLUMNS, {'id': 'int'})
+        row = plan.to_tsv(line, line.index('(')).split('\t')
+        self.assertTrue(row[0].isdigit())
+
+    def test_values_and_tsv_stream(self):
+        randomise.set_secret('sekrit')
+        self.addCleanup(randomise.set_secret, None)
+        plan = plans.compile_plan('t', _COLUMNS, {'name': 'varchar'})
+        line = ('INSERT INTO `t` VALUES ' +
+                ','.join("(%d,'name %d','x),(y\\'z')" % (i, i)
+                         for i in range(100)) + ';\n')
+        pos = line.index('(')
+        for max_buffer in (30, 1000):
+            f = StringIO.StringIO(line)
+            start = f.readline(max_buffer)
+            batches = list(plan.values_stream(start, pos, f.readline,
+                                              max_buffer))
+            self.assertTrue(len(batches) > 1)
+            self.assertEqual(plan.values(line, pos), sum(batches, []))
+
+            f = StringIO.StringIO(line)
+            start = f.readline(max_buffer)
+            self.assertEqual(plan.to_tsv(line, pos),
+                             ''.join(plan.tsv_stream(start, pos, f.readline,
+                                                     max_buffer)))
+
+    def test_rewrite_stream_row_too_big(self):
+        plan = plans.compile_plan('t', _COLUMNS, {'name': 'varchar'})
+        line = "INSERT INTO `t` VALUES (1,'%s','b');\n" % ('a' * 100)
+        f = StringIO.StringIO(line)
+        pieces = plan.rewrite_stream(f.readline(50), line.index('('),
+                                     f.readline, 50)
+        self.assertRaises(ValueError, list, pieces)
+
+    def test_pickle(self):
+        plan = plans.compile_plan('t', _COLUMNS, {'name': 'uuid'})
+        copy = pickle.loads(pickle.dumps(plan, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual('t', copy.table)
+        self.assertEqual(3, copy.width)
+        self.assertEqual(frozenset([0]), copy.numeric)
+        self.assertEqual([(1, 'name', 'uuid')],
+                         [(c.index, c.name, c.anon_type)
+                          for c in copy.columns])
+        line = "INSERT INTO `t` VALUES (1,'a','b');\n"
+        self.assertIn("'fake", copy.rewrite(line, line.index('(')))
@@ -0,0 +1,77 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import testtools
+
+from fuzzy_happiness import policy
+
+
+_POLICY = {
+    'types': {'email': 'varchar', 'address': {'type': 'email'}},
+    'tables': {
+        '*': {'password': 'varchar'},
+        'shadow_*': {'hostname': 'hostname', 'notes': 'text'},
+        'shadow_instances': {'notes': None, 'mail': 'address'},
+        'instances': {'hostname': 'hostname'},
+    },
+}
+
+
+class TestPolicy(testtools.TestCase):
+
+    def setUp(self):
+        super(TestPolicy, self).setUp()
+        self.policy = policy.compile_policy(_POLICY)
+
+    def test_exact_table(self):
+        self.assertEqual({'hostname': 'hostname', 'password': 'varchar'},
+                         self.policy['instances'])
+        self.assertEqual(['instances', 'shadow_instances'],
+                         sorted(self.policy.keys()))
+
+    def test_patterns_and_overrides(self):
+        self.assertEqual({'hostname': 'hostname', 'password': 'varchar',
+                          'mail': 'varchar'},
+                         self.policy.get('shadow_instances'))
+        self.assertEqual({'hostname': 'hostname', 'password': 'varchar',
+                          'notes': 'text'},
+                         self.policy.get('shadow_services'))
+
+    def test_unmatched(self):
+        p = policy.compile_policy({'tables': {'shadow_*': {'a': 'uuid'}}})
+        self.assertIsNone(p.get('services'))
+        self.assertNotIn('services', p)
+        self.assertIn('shadow_services', p)
+        self.assertRaises(KeyError, lambda: p['services'])
+
+    def test_invalid(self):
+        for document in ([], {'tables': {'t': []}}, {'colums': {}},
+                         {'tables': {'t': {'c': 'no_such_type'}}},
+                         {'types': {'a': 'b', 'b': 'a'},
+                          'tables': {'t': {'c': 'a'}}},
+                         {'types': {'a': {'base': 'uuid'}}}):
+            self.assertRaises(ValueError, policy.compile_policy, document)
+
+    def test_load_json(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'policy.json')
+        with open(path, 'w') as f:
+            json.dump(_POLICY, f)
+        self.assertEqual(self.policy.get('shadow_instances'),
+                         policy.load_policy(path).get('shadow_instances'))
@@ -0,0 +1,76 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import testtools
+
+from sqlalchemy import Column, create_engine, DateTime, Integer, MetaData
+from sqlalchemy import String, Table, Text
+from sqlalchemy.dialects import mysql
+
+from fuzzy_happiness import pushdown
+
+
+class TestPushdown(testtools.TestCase):
+
+    def setUp(self):
+        super(TestPushdown, self).setUp()
+        self.table = Table('instances', MetaData(),
+                           Column('id', Integer, primary_key=True),
+                           Column('launched_at', DateTime),
+                           Column('access_ip_v4', String(39)),
+                           Column('uuid', String(36)),
+                           Column('display_name', String(255)),
+                           Column('fingerprint', String(200)),
+                           Column('key_data', Text))
+
+    def sql(self, name, column_type):
+        expression = pushdown.expression_for(self.table.c[name], column_type)
+        update = self.table.update().values({name: expression})
+        return str(update.compile(dialect=mysql.dialect(),
+                                  compile_kwargs={'literal_binds': True}))
+
+    def test_python_only_types(self):
+        self.assertIsNone(pushdown.expression_for(
+            self.table.c.display_name, 'varchar'))
+
+    def test_special_values_kept(self):
+        self.assertIn('WHEN (instances.uuid IS NULL OR '
+                      "trim(instances.uuid) = '' OR "
+                      "instances.uuid = 'NULL') THEN instances.uuid",
+                      self.sql('uuid', 'uuid'))
+
+    def test_uuid(self):
+        self.assertIn("concat('fake', substring(uuid(), 6))",
+                      self.sql('uuid', 'uuid'))
+
+    def test_datetime(self):
+        self.assertIn("timestampadd(SECOND, floor(rand() * 1356998400), "
+                      "'1971-01-01 00:00:00')",
+                      self.sql('launched_at', 'datetime'))
+
+    def test_ip_address_keeps_octets(self):
+        sql = self.sql('access_ip_v4', 'ip_address')
+        self.assertEqual(3, sql.count('concat_ws'))
+        self.assertIn('ELSE NULL', sql)
+
+    def test_hexstring(self):
+        # Enough digits for the whole column, not one block repeated
+        sql = self.sql('fingerprint', 'hexstring')
+        self.assertEqual(4, sql.count('sha2(rand(), 256)'))
+        self.assertNotIn('repeat', sql)
+        self.assertIsNone(pushdown.expression_for(self.table.c.key_data,
+                                                  'hexstring'))
+
+    def test_supports(self):
+        self.assertFalse(pushdown.supports(create_engine('sqlite://')))
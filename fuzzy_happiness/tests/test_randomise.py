@@ -18,11 +18,15 @@ import re
 import string
 import testtools
 
+from fuzzy_happiness.randomise import get_transform
 from fuzzy_happiness.randomise import random_char_replacement
 from fuzzy_happiness.randomise import random_hexstring_replacement
 from fuzzy_happiness.randomise import random_ipaddress_replacement
 from fuzzy_happiness.randomise import random_json_replacement
+from fuzzy_happiness.randomise import random_number_replacement
 from fuzzy_happiness.randomise import randomness
+from fuzzy_happiness.randomise import randomness_batch
+from fuzzy_happiness.randomise import set_secret
 from fuzzy_happiness.randomise import random_pathname_replacement
 from fuzzy_happiness.randomise import random_str_replacement
 from fuzzy_happiness.randomise import random_hostname_replacement
@@ -190,6 +194,23 @@ class TestRandomIPAddressReplacement(testtools.TestCase):
         self.assertEqual(None, new_addr)
 
 
+class TestRandomNumberReplacement(testtools.TestCase):
+    def check_number(self, number, pattern):
+        for i in range(50):
+            self.assertTrue(re.match(pattern,
+                                     random_number_replacement(number)))
+
+    def test_negative(self):
+        self.check_number('-12345', r'^-[0-9]{5}$')
+
+    def test_float(self):
+        self.check_number('3.8e07', r'^[0-9]\.[0-9]e07$')
+        self.check_number('-.5', r'^-\.[0-9]$')
+
+    def test_hex(self):
+        self.check_number('0x65580', r'^0x[0-9a-fA-F]{5}$')
+
+
 class TestRandomJSONReplacement(testtools.TestCase):
 
     def check_json(self, input):
@@ -252,3 +273,77 @@ class TestRandomHostnameReplacement(testtools.TestCase):
         new_str = random_hostname_replacement('computer-63.foobar.com')
         for i in new_str:
             self.assertIn(i, allowable)
+
+
+class TestRandomness(testtools.TestCase):
+
+    def test_special_cases(self):
+        for column_type in ('varchar', 'uuid', 'datetime', 'unknown'):
+            transform = get_transform(column_type)
+            for value in (None, 'NULL', '', '  '):
+                self.assertEqual(value, transform(value))
+                self.assertEqual(value, randomness(value, column_type))
+
+    def test_uuid(self):
+        new_uuid = randomness('0b9a54ee-8b6b-4d4c-9a57-3ad1b9a8bd31', 'uuid')
+        self.assertTrue(re.match('^fake[0-9a-f]{3}-[0-9a-f]{4}-4', new_uuid))
+
+    def test_hexstring(self):
+        new_str = get_transform('hexstring')('abc123')
+        self.assertEqual(6, len(new_str))
+        for i in new_str:
+            self.assertIn(i, string.hexdigits)
+
+
+class TestRandomnessBatch(testtools.TestCase):
+
+    def test_varchar(self):
+        values = ['fred', None, 'NULL', '', 'Wilma 42', 17]
+        new = randomness_batch(values, 'varchar')
+        self.assertEqual(len(values), len(new))
+        self.assertEqual([None, 'NULL', ''], new[1:4])
+        self.assertEqual(4, len(new[0]))
+        for i in new[0]:
+            self.assertIn(i, string.ascii_lowercase)
+        self.assertEqual(' ', new[4][5])
+        self.assertIn(new[4][0], string.ascii_uppercase)
+        for i in new[4][6:] + new[5]:
+            self.assertIn(i, string.digits)
+
+    def test_seeded(self):
+        values = ['fred', 'wilma', 'barney']
+        random.seed(42)
+        first = randomness_batch(values, 'varchar')
+        random.seed(42)
+        self.assertEqual(first, randomness_batch(values, 'varchar'))
+
+    def test_other_types(self):
+        new = randomness_batch(['192.168.1.1', 'NULL'], 'ip_address')
+        self.assertEqual(4, len(new[0].split('.')))
+        self.assertEqual('NULL', new[1])
+
+
+class TestKeyed(testtools.TestCase):
+
+    def setUp(self):
+        super(TestKeyed, self).setUp()
+        set_secret('sekrit')
+        self.addCleanup(set_secret, None)
+
+    def test_deterministic(self):
+        for column_type in ('varchar', 'uuid', 'datetime', 'ip_address',
+                            'hostname', 'string'):
+            value = 'host-1.example.com'
+            first = randomness(value, column_type)
+            random.seed(1)
+            self.assertEqual(first, randomness(value, column_type))
+            self.assertEqual(first, get_transform(column_type)(value))
+            self.assertEqual([first, first],
+                             randomness_batch([value, value], column_type))
+
+    def test_keyed_by_secret_type_and_value(self):
+        first = randomness('fred flintstone', 'varchar')
+        self.assertNotEqual(first, randomness('fred flintstonf', 'varchar'))
+        self.assertNotEqual(first, randomness('fred flintstone', 'text'))
+        set_secret('other')
+        self.assertNotEqual(first, randomness('fred flintstone', 'varchar'))
@@ -0,0 +1,144 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import StringIO
+import tempfile
+
+import testtools
+
+from fuzzy_happiness import output
+from fuzzy_happiness import randomise
+from fuzzy_happiness import regexp_fuzzify
+
+
+_CREATE = """DROP TABLE IF EXISTS `instances`;
+CREATE TABLE `instances` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `hostname` varchar(255) DEFAULT NULL,
+  `notes` text,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+LOCK TABLES `instances` WRITE;
+"""
+
+# What mysqldump --databases writes before the tables of each database
+_PREAMBLE = ("CREATE DATABASE /*!32312 IF NOT EXISTS*/ `nova_x` "
+             "/*!40100 DEFAULT CHARACTER SET utf8 */;\n"
+             "\n"
+             "USE `nova_x`;\n"
+             "\n")
+
+_ANON_FIELDS = {'instances': {'hostname': 'varchar(255)'}}
+
+
+def _dump(inserts):
+    lines = []
+    for n in range(inserts):
+        lines.append("INSERT INTO `instances` VALUES (%d,'host-%d','a'),"
+                     "(%d,'db-%d.example.com',NULL);\n"
+                     % (2 * n, n, 2 * n + 1, n))
+    return _CREATE + ''.join(lines) + 'UNLOCK TABLES;\n'
+
+
+class TestAnonymise(testtools.TestCase):
+
+    def setUp(self):
+        super(TestAnonymise, self).setUp()
+        self.override('seed', 1)
+        self.override('add_descriptive_comments', False)
+
+    def override(self, name, value):
+        regexp_fuzzify.CONF.set_override(name, value)
+        self.addCleanup(regexp_fuzzify.CONF.clear_override, name)
+
+    def anonymise(self, dump, workers, rows_per_insert=0):
+        self.override('workers', workers)
+        self.override('rows_per_insert', rows_per_insert)
+        w = StringIO.StringIO()
+        out = w
+        if rows_per_insert:
+            out = output.Rebatcher(w, rows_per_insert)
+        regexp_fuzzify._anonymise(regexp_fuzzify.Fuzzer(_ANON_FIELDS),
+                                  StringIO.StringIO(dump), out)
+        if rows_per_insert:
+            out.flush()
+        return w.getvalue()
+
+    def test_anonymise(self):
+        out = self.anonymise(_dump(3), 1)
+        self.assertTrue(out.startswith(_CREATE))
+        self.assertNotIn('host-', out)
+        self.assertIn("(0,'", out)
+        self.assertIn("','a'),(1,'", out)
+        self.assertTrue(out.endswith('UNLOCK TABLES;\n'))
+
+    def test_seed(self):
+        dump = _dump(3)
+        self.assertEqual(self.anonymise(dump, 1), self.anonymise(dump, 1))
+
+    def test_workers(self):
+        dump = _dump(50)
+        self.assertEqual(self.anonymise(dump, 1), self.anonymise(dump, 4))
+
+    def test_no_create_info(self):
+        dump = _dump(3)
+        dump = dump[dump.index('LOCK TABLES'):]
+        for workers in (1, 4):
+            self.assertRaises(ValueError, self.anonymise, dump, workers)
+
+    def test_no_create_info_unconfigured(self):
+        dump = _dump(3).replace('instances', 'services')
+        dump = dump[dump.index('LOCK TABLES'):]
+        self.assertEqual(dump, self.anonymise(dump, 1))
+
+    def test_long_lines_rebatched(self):
+        # Keyed mode makes the output independent of how rows are batched
+        randomise.set_secret('sekrit')
+        self.addCleanup(randomise.set_secret, None)
+        dump = _dump(1).replace(
+            "(1,'db-0.example.com',NULL)",
+            ','.join("(%d,'db-%d.example.com',NULL)" % (n, n)
+                     for n in range(1, 200)))
+        whole = self.anonymise(dump, 1, rows_per_insert=7)
+        self.override('max_buffer', 100)
+        self.assertEqual(whole, self.anonymise(dump, 1, rows_per_insert=7))
+        self.assertEqual(29, whole.count('INSERT'))
+
+    def test_databases_preamble(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        dump = _PREAMBLE + _dump(2)
+        self.override('workers', 1)
+        for output_format in output.FORMATS:
+            self.override('format', output_format)
+            path = os.path.join(tmpdir, output_format)
+            with output.open_output(path, output_format, 1000) as w:
+                regexp_fuzzify._anonymise(
+                    regexp_fuzzify.Fuzzer(_ANON_FIELDS),
+                    StringIO.StringIO(dump), w)
+
+            if output_format == 'sql':
+                with open(path) as f:
+                    self.assertTrue(f.read().startswith(_PREAMBLE + _CREATE))
+            elif output_format == 'tsv':
+                with open(os.path.join(path, 'schema.sql')) as f:
+                    self.assertIn('USE `nova_x`;\n', f.read())
+                with open(os.path.join(path, 'instances.tsv')) as f:
+                    self.assertEqual(4, len(f.readlines()))
+            else:
+                self.assertIn('nova_x.instances.00000.sql',
+                              os.listdir(path))
@@ -0,0 +1,170 @@
+# Copyright 2013 Rackspace Australia
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import testtools
+
+from fuzzy_happiness import CSVParser
+from fuzzy_happiness import index
+from fuzzy_happiness import randomise
+from fuzzy_happiness import sqlparse_fuzzify
+
+
+_INSTANCES = """--
+-- Table structure for table `instances`
+--
+
+DROP TABLE IF EXISTS `instances`;
+CREATE TABLE `instances` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `hostname` varchar(255) DEFAULT NULL,
+  `notes` text,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+LOCK TABLES `instances` WRITE;
+INSERT INTO `instances` VALUES (1,'host-1','a ),( b'),(2,NULL,'c');
+INSERT INTO `instances` VALUES (3,'db.example.com','it\\'s');
+UNLOCK TABLES;
+
+"""
+
+_SERVICES = """--
+-- Table structure for table `services`
+--
+
+DROP TABLE IF EXISTS `services`;
+CREATE TABLE `services` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `host` varchar(255) DEFAULT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+LOCK TABLES `services` WRITE;
+INSERT INTO `services` VALUES (1,'compute-1'),(2,'compute-2');
+UNLOCK TABLES;
+"""
+
+_DUMP = '-- MySQL dump 10.13\n\n' + _INSTANCES + _SERVICES
+
+
+class TestDumpProcessor(testtools.TestCase):
+
+    def setUp(self):
+        super(TestDumpProcessor, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def process(self, dump, anon_fields, workers=1, indexed=False):
+        input_path = os.path.join(self.tmpdir, 'dump.sql')
+        output_path = os.path.join(self.tmpdir, 'dump.sql.post')
+        with open(input_path, 'w') as f:
+            f.write(dump)
+        index_path = None
+        if indexed:
+            index_path = os.path.join(self.tmpdir, 'dump.sql.fhindex')
+            with open(input_path) as f:
+                index.write_index(index_path, input_path,
+                                  index.build_index(f))
+        self.dp = sqlparse_fuzzify.DumpProcessor(input_path, output_path,
+                                                 anon_fields, workers,
+                                                 index_path)
+        self.dp.read_sql_dump()
+        with open(output_path) as f:
+            return f.read()
+
+    def rows(self, output, table):
+        csv = CSVParser.CSVParser()
+        rows = []
+        for line in output.splitlines():
+            m = index.INSERT_RE.match(line)
+            if m and m.group(1) == table:
+                rows.extend([line[start:end] for start, end in spans]
+                            for spans in csv.row_spans(line, m.end()))
+        return rows
+
+    def test_inserts_anonymised(self):
+        output = self.process(_DUMP, {'instances': {'hostname': 'hostname'}})
+        rows = self.rows(output, 'instances')
+        self.assertEqual([['1', "'a ),( b'"], ['2', "'c'"],
+                          ['3', "'it\\'s'"]],
+                         [[row[0], row[2]] for row in rows])
+        self.assertEqual('NULL', rows[1][1])
+        self.assertNotEqual("'host-1'", rows[0][1])
+        self.assertEqual(len("'host-1'"), len(rows[0][1]))
+        self.assertIn("INSERT INTO `services` VALUES (1,'compute-1'),"
+                      "(2,'compute-2');\n", output)
+
+    def test_nothing_to_anonymise(self):
+        self.assertEqual(_DUMP, self.process(_DUMP, {}))
+
+    def test_bounded_memory(self):
+        insert = "INSERT INTO `instances` VALUES (1,'host-1','notes');\n"
+        dump = _INSTANCES.replace('UNLOCK', insert * 10000 + 'UNLOCK')
+        output = self.process(dump, {'instances': {'hostname': 'hostname'}})
+        self.assertEqual(10003, len(self.rows(output, 'instances')))
+        # Only the DDL is ever held, never the inserts
+        self.assertTrue(self.dp.high_water < len(_INSTANCES))
+
+    def test_workers(self):
+        # Keyed mode makes the output independent of which process does what
+        randomise.set_secret('sekrit')
+        self.addCleanup(randomise.set_secret, None)
+        self.patch(sqlparse_fuzzify, '_SEGMENT_SIZE', 100)
+        insert = "INSERT INTO `instances` VALUES (%d,'host-%d','notes');\n"
+        dump = _DUMP.replace('UNLOCK TABLES;\n\n--',
+                             ''.join(insert % (i, i) for i in range(500)) +
+                             'UNLOCK TABLES;\n\n--')
+        anon_fields = {'instances': {'hostname': 'hostname'}}
+        serial = self.process(dump, anon_fields)
+        self.assertEqual(serial, self.process(dump, anon_fields, workers=3))
+        self.assertEqual(['dump.sql', 'dump.sql.post'],
+                         sorted(os.listdir(self.tmpdir)))
+
+        # Handling the dump as byte ranges makes no difference either
+        self.assertEqual(serial, self.process(dump, anon_fields,
+                                              indexed=True))
+        self.assertEqual(serial, self.process(dump, anon_fields, workers=3,
+                                              indexed=True))
+
+    def test_indexed_nothing_to_anonymise(self):
+        self.assertEqual(_DUMP, self.process(_DUMP, {}, indexed=True))
+
+    def test_compact(self):
+        # --compact dumps have no comments between tables
+        dump = ''.join(line for line in _DUMP.splitlines(True)
+                       if not line.startswith('--'))
+        anon_fields = {'instances': {'hostname': 'hostname'}}
+        for workers, indexed in ((1, False), (3, False), (1, True)):
+            output = self.process(dump, anon_fields, workers, indexed)
+            self.assertNotIn('host-1', output)
+            self.assertNotIn('db.example.com', output)
+            self.assertIn("INSERT INTO `services` VALUES (1,'compute-1'),"
+                          "(2,'compute-2');\n", output)
+
+    def test_inserts_use_their_own_table(self):
+        # Inserts into instances after services has been created
+        dump = _DUMP + ("INSERT INTO `instances` VALUES "
+                        "(4,'secret-host','e');\n")
+        output = self.process(dump, {'instances': {'hostname': 'hostname'}})
+        self.assertNotIn('secret-host', output)
+        self.assertEqual(4, len(self.rows(output, 'instances')))
+
+    def test_no_create_table(self):
+        dump = _DUMP[_DUMP.index('LOCK TABLES'):]
+        self.assertRaises(SystemExit, self.process, dump,
+                          {'instances': {'hostname': 'hostname'}})
+        self.assertEqual(dump, self.process(dump, {}))